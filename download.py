@@ -1,103 +1,1197 @@
-import argparse
-from concurrent.futures import ThreadPoolExecutor
-import getpass
+from __future__ import annotations
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import errno
 import hashlib
 import json
+import mmap
 import os.path
+import random
+import shutil
 import sys
+import threading
 import time
 import traceback
-from typing import Dict, List
-from urllib.parse import quote
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Union
+from urllib.parse import quote, urlsplit
+
+# requests/urllib3、concurrent.futures、argparse等导入较慢，放到第一次用到的函数里导入，
+# 只用file_hash、print_split等本地功能的脚本不需要承担这部分启动时间
+if TYPE_CHECKING:
+    import requests
+    from requests.adapters import HTTPAdapter
+
+HASH_METHODS = {"sha256": hashlib.sha256, "sha512": hashlib.sha512, "md5": hashlib.md5, "sha1": hashlib.sha1}
+# 预分配时是否用posix_fallocate申请全部磁盘空间；glibc在不支持fallocate的文件系统（NFSv3、很多FUSE）上会逐块写零来模拟，
+# 大文件下载前要先完整写一遍，所以默认关闭，只在确认是本地文件系统时打开
+RESERVE_DISK_SPACE = False
+
+
+class DownloadResult(NamedTuple):
+    path: str
+    sha256: str
 
-import requests
 
 def print_split():
     print("\n\n--------------------------\n")
 
 
-def parallel_download(url: str, local_dir: str, file_name: str, file_size: int = None, proxies: dict = None) -> bool:
-    PART_SIZE = 160 * 1024 * 1024  # every part is 160M
+class HttpSession:
+
+    """
+    线程安全的HTTP会话层：每个线程持有自己的requests.Session，同一host的请求共享一个带keep-alive连接池和重试退避策略的HTTPAdapter，
+    避免每个文件、每个区间都重新进行TCP+TLS握手
+    """
+
+    pool_size = 16
+    retries = 3
+    backoff_factor = 0.5
+    timeout = (30, 120)  # 连接超时和两次读取之间的最长间隔，卡住的连接会抛出超时交给重试逻辑
+    verify = True  # 区间请求（并行下载、分段下载、断点续传）是否校验TLS证书
+    host_configs: Dict[str, dict] = {}
+    _adapters: Dict[str, HTTPAdapter] = {}
+    _generation = 0
+    _local = threading.local()
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, host: str = None, pool_size: int = None, retries: int = None, backoff_factor: float = None,
+                  verify: bool = None):
+        """修改默认配置（host=None）或某个host的配置，已有的连接池会在下次请求时按新配置重建；verify只有全局配置"""
+        config = {k: v for k, v in (("pool_size", pool_size), ("retries", retries), ("backoff_factor", backoff_factor))
+                  if v is not None}
+        if verify is not None:
+            cls.verify = verify
+        with cls._lock:
+            if host is None:
+                for key, value in config.items():
+                    setattr(cls, key, value)
+            else:
+                cls.host_configs.setdefault(host, {}).update(config)
+            for adapter in cls._adapters.values():
+                adapter.close()
+            cls._adapters = {}
+            cls._generation += 1
+
+    @classmethod
+    def adapter(cls, host: str = None) -> HTTPAdapter:
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        with cls._lock:
+            if host not in cls._adapters:
+                config = cls.host_configs.get(host, {})
+                pool_size = config.get("pool_size", cls.pool_size)
+                retry = Retry(total=config.get("retries", cls.retries),
+                              backoff_factor=config.get("backoff_factor", cls.backoff_factor),
+                              status_forcelist=(429, 500, 502, 503, 504))
+                cls._adapters[host] = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                  max_retries=retry)
+            return cls._adapters[host]
+
+    @classmethod
+    def session(cls) -> requests.Session:
+        import requests
+        session = getattr(cls._local, "session", None)
+        if session is None or cls._local.generation != cls._generation:
+            session = requests.Session()
+            session.mount("http://", cls.adapter())
+            session.mount("https://", cls.adapter())
+            cls._local.session, cls._local.generation, cls._local.hosts = session, cls._generation, set()
+        return session
+
+    @classmethod
+    def get(cls, url: str, **kwargs) -> requests.Response:
+        session = cls.session()
+        parsed = urlsplit(url)
+        if parsed.netloc in cls.host_configs and parsed.netloc not in cls._local.hosts:
+            session.mount(f"{parsed.scheme}://{parsed.netloc}/", cls.adapter(parsed.netloc))
+            cls._local.hosts.add(parsed.netloc)
+        kwargs.setdefault("timeout", cls.timeout)
+        return session.get(url, **kwargs)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, size: int) -> float:
+        """取走size个令牌（不足时记为欠账），返回调用方需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimiter:
+
+    """
+    进程内所有下载worker共享的令牌桶限速：total限制总字节速率，per_host限制单个host的字节速率（单位均为bytes/s）
+    worker每收到一块数据就按字节数取令牌，令牌不足时等待欠账还清；正在传输的worker轮流取令牌，
+    传输开始或结束时带宽自动在剩余的worker之间重新分配
+    """
+
+    total: TokenBucket = None
+    hosts: Dict[str, TokenBucket] = {}
+    default_host_rate: float = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, total: float = None, per_host: Dict[str, float] = None, default_host_rate: float = None):
+        """total/default_host_rate为None表示不限速，per_host为{host: bytes/s}"""
+        with cls._lock:
+            cls.total = TokenBucket(total) if total else None
+            cls.hosts = {host: TokenBucket(rate) for host, rate in (per_host or {}).items()}
+            cls.default_host_rate = default_host_rate
+
+    @classmethod
+    def _host_bucket(cls, url: str) -> TokenBucket:
+        host = urlsplit(url).netloc
+        with cls._lock:
+            if host not in cls.hosts and cls.default_host_rate:
+                cls.hosts[host] = TokenBucket(cls.default_host_rate)
+            return cls.hosts.get(host)
+
+    @classmethod
+    def reserve(cls, url: str, size: int) -> float:
+        buckets = [cls.total, cls._host_bucket(url)]
+        return max([bucket.reserve(size) for bucket in buckets if bucket is not None], default=0.0)
+
+    @classmethod
+    def consume(cls, url: str, size: int) -> float:
+        """取走令牌并等待，返回等待的秒数"""
+        delay = cls.reserve(url, size)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    @classmethod
+    def chunk_size(cls, url: str, chunk_size: int) -> int:
+        """限速时把读取块缩小到约1/4秒的数据量，让限速更平滑"""
+        rates = [bucket.rate for bucket in (cls.total, cls._host_bucket(url)) if bucket is not None]
+        if not rates:
+            return chunk_size
+        return max(64 * 1024, min(chunk_size, int(min(rates) / 4)))
+
+
+class BufferPool:
+
+    """
+    进程内所有下载流共享的接收缓冲池：每个流从池中借一块固定大小的bytearray，用readinto把数据直接读进缓冲区，
+    用完归还复用，不再为每一块数据分配新的bytes对象；借出的缓冲区总大小不超过max_bytes，超出时借用方等待其他流归还
+    """
+
+    buffer_size = 1024 * 1024
+    max_bytes = 64 * 1024 * 1024
+    _free: List[bytearray] = []
+    _in_use = 0
+    _cond = threading.Condition()
+
+    @classmethod
+    def configure(cls, buffer_size: int = None, max_bytes: int = None):
+        """修改缓冲区大小和借出总量上限（单位均为字节），已归还的旧缓冲区会被丢弃"""
+        with cls._cond:
+            if buffer_size is not None:
+                cls.buffer_size = buffer_size
+            if max_bytes is not None:
+                cls.max_bytes = max_bytes
+            cls._free = []
+            cls._cond.notify_all()
+
+    @classmethod
+    def acquire(cls) -> bytearray:
+        with cls._cond:
+            # 上限小于一块缓冲区时至少允许一个流继续，避免所有下载永远等待
+            while cls._in_use > 0 and cls._in_use + cls.buffer_size > cls.max_bytes:
+                cls._cond.wait()
+            buffer = cls._free.pop() if cls._free else bytearray(cls.buffer_size)
+            cls._in_use += len(buffer)
+            return buffer
+
+    @classmethod
+    def release(cls, buffer: bytearray):
+        with cls._cond:
+            cls._in_use -= len(buffer)
+            if len(buffer) == cls.buffer_size and len(cls._free) * cls.buffer_size < cls.max_bytes:
+                cls._free.append(buffer)
+            cls._cond.notify()
+
+    @classmethod
+    @contextmanager
+    def buffer(cls, size: int = None) -> memoryview:
+        """借一块缓冲区，返回其前size字节（不超过buffer_size）的memoryview，退出时自动归还"""
+        buffer = cls.acquire()
+        view = memoryview(buffer)[:min(size or len(buffer), len(buffer))]
+        try:
+            yield view
+        finally:
+            view.release()
+            cls.release(buffer)
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """所有下载和接口请求都经过共享的HttpSession连接池"""
+    return HttpSession.get(url, **kwargs)
+
+
+class RangeJournal:
+
+    """
+    断点续传日志，以 <file>.journal 的形式保存在目标文件旁边，记录已完成并校验过的字节区间[start, end)
+    add只更新内存中的区间，距上次写入超过save_interval秒或save_bytes字节时才写回磁盘；下载失败时调用方flush，
+    进程退出时未写入的日志也会flush，中断后日志最多落后于文件内容，不会记录没有写入的数据
+    """
+
+    save_interval = 1.0
+    save_bytes = 64 * 1024 * 1024
+    _unsaved = None
+    _lock = threading.Lock()
+
+    def __init__(self, file_path: str, file_size: int, etag: str = None):
+        self.file_path = file_path
+        self.path = file_path + ".journal"
+        self.file_size = file_size
+        self.etag = etag
+        self.ranges = []
+        self.dirty = False
+        self.removed = False
+        self.unsaved_bytes = 0
+        self.saved_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    @classmethod
+    def load(cls, file_path: str, file_size: int, etag: str = None, require_file: bool = True) -> "RangeJournal":
+        """
+        目标文件不存在时日志作废；数据不写在目标文件中时（如分段文件模式，目标文件在合并后才出现）传入require_file=False，
+        由调用方按实际的数据文件核对日志
+        """
+        journal = cls(file_path, file_size, etag)
+        if not os.path.isfile(journal.path) or require_file and not os.path.isfile(file_path):
+            return journal
+        try:
+            with open(journal.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data["size"] == file_size and data.get("etag") == etag:
+                journal.ranges = [(start, end) for start, end in data["ranges"]]
+            else:
+                print(f"journal does not match remote file, restart download: {journal.path}")
+        except Exception as e:
+            print(f"读取续传日志失败：{journal.path} {e}")
+        return journal
+
+    @classmethod
+    def _track(cls, journal: "RangeJournal"):
+        """记录有未写入修改的日志，进程退出时统一flush"""
+        with cls._lock:
+            if cls._unsaved is None:
+                import atexit
+                import weakref
+                cls._unsaved = weakref.WeakSet()
+                atexit.register(cls._flush_all)
+            cls._unsaved.add(journal)
+
+    @classmethod
+    def _flush_all(cls):
+        with cls._lock:
+            journals = list(cls._unsaved)
+        for journal in journals:
+            journal.flush()
+
+    def add(self, start: int, end: int):
+        with self.lock:
+            merged = []
+            for s, e in sorted(self.ranges + [(start, end)]):
+                if merged and s <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+                else:
+                    merged.append((s, e))
+            self.ranges = merged
+            self.unsaved_bytes += end - start
+            due = self.unsaved_bytes >= self.save_bytes or time.monotonic() - self.saved_time >= self.save_interval
+            if not self.dirty:
+                self.dirty = True
+                self._track(self)
+            self.changed.notify_all()
+        if due:
+            self.save()
+
+    def _covered(self, start: int) -> int:
+        for s, e in self.ranges:
+            if s <= start < e:
+                return e
+        return start
+
+    def wait(self, start: int, timeout: float = None) -> int:
+        """等待start处的数据完成，返回从start起连续完成部分的终点，超时仍未完成时返回start"""
+        with self.changed:
+            self.changed.wait_for(lambda: self._covered(start) > start, timeout)
+            return self._covered(start)
+
+    def missing(self, start: int = 0, end: int = None) -> List[tuple]:
+        end = self.file_size if end is None else end
+        gaps = []
+        with self.lock:
+            for s, e in self.ranges:
+                if e <= start or s >= end:
+                    continue
+                if s > start:
+                    gaps.append((start, s))
+                start = max(start, e)
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+    def completed_bytes(self) -> int:
+        with self.lock:
+            return sum(e - s for s, e in self.ranges)
+
+    def save(self):
+        """把内存中的区间写入日志文件，序列化在快照上进行，不阻塞并发的add；remove之后不再写入"""
+        with self.save_lock:
+            with self.lock:
+                if self.removed:
+                    return
+                ranges, self.dirty, self.unsaved_bytes, self.saved_time = list(self.ranges), False, 0, time.monotonic()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"size": self.file_size, "etag": self.etag, "ranges": ranges}, f)
+            os.replace(tmp_path, self.path)
+
+    def flush(self):
+        """有未写入的修改时写回磁盘"""
+        if self.dirty:
+            self.save()
+
+    def reset(self):
+        """丢弃已完成的区间（目标文件重新创建时），立即写入，旧日志不会在中断后误认新文件的内容"""
+        with self.lock:
+            self.ranges = []
+        if os.path.exists(self.path):
+            self.save()
+
+    def remove(self):
+        with self.save_lock:
+            self.removed = True
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def _check_range_response(response: requests.Response, start: int, end: int):
+    """确认服务端返回的正是请求的[start, end)区间"""
+    if response.status_code != 206:
+        raise IOError(f"server ignored Range header, status = {response.status_code}")
+    content_range = response.headers.get("Content-Range", "")
+    if not content_range.startswith(f"bytes {start}-{end - 1}/"):
+        raise IOError(f"unexpected Content-Range {content_range}, expect {start}-{end - 1}")
+
+
+def _readinto(response: requests.Response, buffer: memoryview) -> int:
+    """把stream=True的响应体读入buffer，返回读到的字节数，0表示已读完"""
+    response.raw.decode_content = True
+    return response.raw.readinto(buffer)
+
+
+def _open_range(url: str, start: int, end: int, proxies: dict = None) -> requests.Response:
+    r = http_get(url, headers={'Range': f'bytes={start}-{end - 1}'}, stream=True, proxies=proxies,
+                 verify=HttpSession.verify)
+    r.raise_for_status()
+    _check_range_response(r, start, end)
+    return r
+
+
+class Mirrors:
+
+    """
+    同一文件在多个等价端点（镜像、内部缓存）上的url。先探测各端点的首字节延迟，之后每个区间按各host最近的单连接吞吐加权随机选url，
+    快的镜像分到更多区间，慢镜像上拖尾的区间由RangeScheduler转给其他worker；连续失败的镜像暂停使用，直到下次探测恢复
+    统计按host在进程内共享，超过probe_interval秒重新探测。多个来源拼出的文件必须用sha256校验
+    """
+
+    probe_interval = 300
+    max_failures = 3
+    _hosts: Dict[str, dict] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, urls: Union[str, List[str]]):
+        self.urls = [urls] if isinstance(urls, str) else list(urls)
+
+    @classmethod
+    def _stat(cls, url: str) -> dict:
+        return cls._hosts.setdefault(urlsplit(url).netloc, {"rate": None, "latency": None, "failures": 0,
+                                                            "probe_time": 0.0, "active": 0})
+
+    def probe(self, proxies: dict = None):
+        """并发请求各url的第一个字节，记录首字节延迟；请求失败的镜像暂停使用"""
+        with self._lock:
+            stale = [url for url in self.urls if time.time() - self._stat(url)["probe_time"] > self.probe_interval]
+
+        def run(url: str):
+            begin = time.monotonic()
+            try:
+                with _open_range(url, 0, 1, proxies) as r:
+                    r.content
+                latency = time.monotonic() - begin
+            except Exception as e:
+                print(f"probe mirror {url} failed with {e}")
+                latency = None
+            with self._lock:
+                self._stat(url).update(latency=latency, probe_time=time.time(),
+                                       failures=0 if latency is not None else self.max_failures)
+
+        if stale:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(stale), thread_name_prefix="probe") as executor:
+                list(executor.map(run, stale))
+
+    def _alive(self) -> List[str]:
+        return [url for url in self.urls if self._stat(url)["failures"] < self.max_failures] or self.urls
+
+    def pick(self) -> str:
+        """为下一个区间选择url，结束后必须调用record或failed"""
+        with self._lock:
+            alive = self._alive()
+            stats = {url: self._stat(url) for url in alive}
+            # 还没有吞吐数据的镜像先分一个区间测速，延迟低的优先
+            fresh = [url for url in alive if stats[url]["rate"] is None and stats[url]["active"] == 0]
+            rated = [url for url in alive if stats[url]["rate"]]
+            if fresh:
+                url = min(fresh, key=lambda u: float("inf") if stats[u]["latency"] is None else stats[u]["latency"])
+            elif rated:
+                url = random.choices(rated, weights=[stats[u]["rate"] for u in rated])[0]
+            else:
+                url = alive[0]
+            stats[url]["active"] += 1
+            return url
+
+    def record(self, url: str, size: int, seconds: float):
+        with self._lock:
+            stat = self._stat(url)
+            stat["active"] -= 1
+            stat["failures"] = 0
+            if size > 0 and seconds > 0:
+                rate = size / seconds
+                stat["rate"] = rate if stat["rate"] is None else 0.7 * stat["rate"] + 0.3 * rate
+
+    def failed(self, url: str):
+        with self._lock:
+            stat = self._stat(url)
+            stat["active"] -= 1
+            stat["failures"] += 1
+
+    def best(self) -> str:
+        """当前最快的url：优先按吞吐，其次按探测延迟，都没有时为第一个url"""
+        with self._lock:
+            stats = {url: self._stat(url) for url in self._alive()}
+        return min(stats, key=lambda u: (-(stats[u]["rate"] or 0),
+                                         float("inf") if stats[u]["latency"] is None else stats[u]["latency"]))
+
+
+class StreamingHasher:
+
+    """
+    边下载边按文件顺序计算摘要，避免下载完成后再完整读一遍文件
+    到达的数据正好接在已计算部分之后时直接更新；乱序到达的区间先记下，等前面补齐后从文件读回（刚写入，通常还在页缓存里）
+    """
+
+    def __init__(self, file_path: str, method: str = "sha256", done_ranges: List[tuple] = ()):
+        self.file_path = file_path
+        self.hash = HASH_METHODS[method]()
+        self.pos = 0
+        self.ranges = list(done_ranges)
+        self.lock = threading.Lock()
+
+    def update(self, offset: int, data):
+        with self.lock:
+            if offset == self.pos:
+                self.hash.update(data)
+                self.pos += len(data)
+            else:
+                self.ranges.append((offset, offset + len(data)))
+            self._catch_up()
+
+    def _catch_up(self):
+        ranges = sorted(self.ranges)
+        end = self.pos
+        while ranges and ranges[0][0] <= end:
+            end = max(end, ranges.pop(0)[1])
+        self.ranges = ranges
+        if end > self.pos:
+            self._read_back(end)
+
+    def _read_back(self, end: int):
+        with open(self.file_path, "rb") as f:
+            f.seek(self.pos)
+            while self.pos < end and (chunk := f.read(min(4 * 1024 * 1024, end - self.pos))):
+                self.hash.update(chunk)
+                self.pos += len(chunk)
+
+    def hexdigest(self, file_size: int) -> str:
+        with self.lock:
+            self._catch_up()
+            if self.pos < file_size:
+                self._read_back(file_size)
+            return self.hash.hexdigest()
+
+
+class DownloadMetrics:
+
+    """
+    下载埋点：各下载路径在区间、文件完成或失败以及传输停顿时发出事件字典，依次交给注册的hook；
+    同时按host累计字节数、耗时、首字节时间、重试和停顿次数，可以导出为Prometheus文本格式
+    """
+
+    hooks = []
+    stall_seconds = 10.0
+    totals: Dict[str, Dict[str, float]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def add_hook(cls, hook):
+        cls.hooks.append(hook)
+
+    @classmethod
+    def remove_hook(cls, hook):
+        cls.hooks.remove(hook)
+
+    @classmethod
+    def emit(cls, event: str, url: str, **fields):
+        host = urlsplit(url).netloc
+        record = {"event": event, "time": time.time(), "url": url, "host": host, **fields}
+        with cls._lock:
+            totals = cls.totals.setdefault(host, {})
+            totals[event] = totals.get(event, 0) + 1
+            if event in ("range_done", "file_done"):
+                totals[f"{event}_bytes"] = totals.get(f"{event}_bytes", 0) + fields.get("bytes", 0)
+                totals[f"{event}_seconds"] = totals.get(f"{event}_seconds", 0) + fields.get("seconds", 0)
+            if fields.get("ttfb") is not None:
+                totals["ttfb_seconds"] = totals.get("ttfb_seconds", 0) + fields["ttfb"]
+                totals["ttfb_count"] = totals.get("ttfb_count", 0) + 1
+        for hook in list(cls.hooks):
+            try:
+                hook(record)
+            except Exception as e:
+                print(f"metrics hook failed with {e}")
+
+    @classmethod
+    def prometheus_text(cls) -> str:
+        names = {
+            "range_done_bytes": "download_range_bytes_total", "range_done_seconds": "download_range_seconds_total",
+            "range_done": "download_ranges_total", "range_failed": "download_range_retries_total",
+            "file_done_bytes": "download_file_bytes_total", "file_done_seconds": "download_file_seconds_total",
+            "file_done": "download_files_total", "file_failed": "download_file_failures_total",
+            "stall": "download_stalls_total", "ttfb_seconds": "download_ttfb_seconds_sum",
+            "ttfb_count": "download_ttfb_seconds_count",
+        }
+        lines = []
+        with cls._lock:
+            for key, name in names.items():
+                lines.append(f"# TYPE {name} counter")
+                lines += [f'{name}{{host="{host}"}} {totals.get(key, 0)}' for host, totals in sorted(cls.totals.items())]
+        return "\n".join(lines) + "\n"
+
+
+class TransferTimer:
+
+    """
+    记录一次传输的首字节时间、字节数和耗时，两次收到数据的间隔超过DownloadMetrics.stall_seconds时发出stall事件
+    chunk的throttled为收到这块数据后在RateLimiter中等待的秒数，从首字节时间和间隔中扣除，限速不会被当作stall
+    """
+
+    def __init__(self, url: str, request_time: float = None, **fields):
+        self.url = url
+        self.fields = fields
+        self.start = request_time or time.monotonic()
+        self.last = self.start
+        self.ttfb = None
+        self.bytes = 0
+
+    def chunk(self, size: int, throttled: float = 0.0):
+        now = time.monotonic()
+        if self.ttfb is None:
+            self.ttfb = now - self.start - throttled
+        elif now - self.last - throttled > DownloadMetrics.stall_seconds:
+            DownloadMetrics.emit("stall", self.url, seconds=now - self.last - throttled, bytes=self.bytes,
+                                 **self.fields)
+        self.last = now
+        self.bytes += size
+
+    def finish(self, event: str, **fields):
+        seconds = time.monotonic() - self.start
+        DownloadMetrics.emit(event, self.url, bytes=self.bytes, seconds=seconds, ttfb=self.ttfb,
+                             throughput=self.bytes / seconds if seconds > 0 else 0.0, **self.fields, **fields)
+
+
+class JsonLinesExporter:
+
+    """把下载事件逐行写成JSON，作为DownloadMetrics的hook使用"""
+
+    def __init__(self, path: str):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def __call__(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusExporter:
+
+    """作为DownloadMetrics的hook使用，最多每interval秒把累计指标以Prometheus文本格式写到path（供node_exporter textfile采集）"""
+
+    def __init__(self, path: str, interval: float = 5.0):
+        self.path = path
+        self.interval = interval
+        self.last_write = 0.0
+
+    def __call__(self, record: dict):
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        self.last_write = time.monotonic()
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(DownloadMetrics.prometheus_text())
+        os.replace(tmp_path, self.path)
+
+
+class DownloadProgress:
+
+    """
+    多文件并发下载的汇总进度，所有文件和区间的worker都向它汇报字节数
+    """
+
+    def __init__(self, total_files: int, total_bytes: int = 0):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.failed_files = 0
+        self.done_bytes = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, size: int):
+        with self.lock:
+            self.done_bytes += size
+
+    def file_done(self, success: bool):
+        with self.lock:
+            if success:
+                self.done_files += 1
+            else:
+                self.failed_files += 1
+
+    def report(self):
+        with self.lock:
+            rate = self.done_bytes / max(time.time() - self.start_time, 1e-3)
+            total = f"/{self.total_bytes / 1024 / 1024 / 1024:.2f}GB" if self.total_bytes else ""
+            print(f"files: {self.done_files}/{self.total_files} done, {self.failed_files} failed, "
+                  f"{self.done_bytes / 1024 / 1024 / 1024:.2f}GB{total} {rate / 1024 / 1024:.2f}MB/s")
+            sys.stdout.flush()
+
+
+class _RangeTask:
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.begin_time = time.time()
+        self.received = 0
+
+    def eta(self) -> float:
+        """按当前速度估计剩余时间，还没收到数据的区间视为最慢"""
+        elapsed = time.time() - self.begin_time
+        if self.received == 0 or elapsed <= 0:
+            return float("inf")
+        return (self.end - self.start) / (self.received / elapsed)
+
+
+class RangeScheduler:
+
+    """
+    动态区间调度：worker从共享队列中领取小区间；队列为空时，空闲的worker把预计最晚完成的区间切成两半，接管其尾部
+    """
+
+    def __init__(self, ranges: List[tuple], chunk_size: int, min_split: int = 1024 * 1024, max_retries: int = 5,
+                 budget: threading.Semaphore = None, progress: DownloadProgress = None):
+        self.pending = deque(_RangeTask(start, min(start + chunk_size, end))
+                             for range_start, end in ranges for start in range(range_start, end, chunk_size))
+        self.active = set()
+        self.min_split = min_split
+        self.retries = max_retries
+        self.received = 0
+        self.aborted = False
+        self.budget = budget or nullcontext()
+        self.progress = progress
+        self.lock = threading.Lock()
+
+    def next(self) -> "_RangeTask":
+        with self.lock:
+            if self.aborted:
+                return None
+            if self.pending:
+                task = self.pending.popleft()
+                task.begin_time = time.time()
+                self.active.add(task)
+                return task
+            victim = max(self.active, key=lambda t: t.eta(), default=None)
+            if victim is None or victim.end - victim.start < 2 * self.min_split:
+                return None
+            middle = (victim.start + victim.end) // 2
+            task = _RangeTask(middle, victim.end)
+            victim.end = middle
+            self.active.add(task)
+            return task
+
+    def advance(self, task: _RangeTask, size: int) -> int:
+        """领取task中接下来的size字节，返回允许写入的字节数（区间尾部可能已被其他worker接管）"""
+        with self.lock:
+            size = max(0, min(size, task.end - task.start))
+            task.start += size
+            task.received += size
+            self.received += size
+        if self.progress is not None:
+            self.progress.update(size)
+        return size
+
+    def done(self, task: _RangeTask):
+        with self.lock:
+            self.active.discard(task)
+
+    def failed(self, task: _RangeTask, offset: int):
+        """task从offset开始的部分没有写入，放回队列重试"""
+        with self.lock:
+            self.active.discard(task)
+            if offset < task.end:
+                self.pending.appendleft(_RangeTask(offset, task.end))
+            self.retries -= 1
+            if self.retries < 0:
+                self.aborted = True
+
+    def has_work(self) -> bool:
+        with self.lock:
+            return not self.aborted and (len(self.pending) > 0 or
+                                         any(t.end - t.start >= 2 * self.min_split for t in self.active))
+
+    def finished(self) -> bool:
+        with self.lock:
+            return not self.pending and not self.active
+
+
+def parallel_download(url: Union[str, List[str]], local_dir: str, file_name: str, file_size: int = None, proxies: dict = None,
+                      preallocate: bool = True, chunk_size: int = 16 * 1024 * 1024, parallels: int = 4,
+                      max_parallels: int = None, budget: threading.Semaphore = None,
+                      progress: DownloadProgress = None, sha256: str = None, journal: RangeJournal = None) -> str:
+    """
+    分段并行下载，支持断点续传：已完成的区间记录在续传日志中，重新下载时只请求缺失的区间
+    preallocate=True 时预分配目标文件，由RangeScheduler动态分配chunk_size大小的区间，各worker直接写入目标文件的对应位置；
+    连接数从parallels开始，只要新增连接能提升总吞吐就继续增加，最多max_parallels（默认为HttpSession的连接池大小）
+    preallocate=False 时按160M静态分段下载到分段文件，最后合并
+    budget为多个文件共享的全局并发预算，每个区间下载时占用一个名额；传入progress时由调用方统一显示进度
+    下载过程中同步计算sha256，成功时返回该摘要，失败或与期望的sha256不一致时返回None
+    url可以是多个镜像上的等价url列表，各区间按镜像的实测速度分配到不同镜像（见Mirrors），只有给出sha256时才会混用多个镜像
+    journal默认从目标文件旁的续传日志加载，调用方也可以传入自己的RangeJournal，在下载过程中用journal.wait读取已完成的部分
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    mirrors = Mirrors(url)
+    if len(mirrors.urls) > 1 and sha256 is None:
+        print(f"no sha256 to verify {file_name}, download from {mirrors.urls[0]} only")
+        mirrors = Mirrors(mirrors.urls[0])
+    if len(mirrors.urls) > 1:
+        mirrors.probe(proxies)
+    url = mirrors.best()
     file_path = os.path.join(local_dir, file_name)
-    tasks = [(file_path, idx*PART_SIZE, (idx+1)*PART_SIZE, url, proxies)
-             for idx in range(int(file_size / PART_SIZE))]
-    if file_size % PART_SIZE != 0:
-        tasks.append((file_path, int(file_size / PART_SIZE)*PART_SIZE, file_size, url, proxies))
-    parallels = 4
+    BlobStore.detach(file_path)
+    if journal is None:
+        # 分段文件模式下已完成的区间在各分段文件里，part_download按分段文件的大小核对
+        journal = RangeJournal.load(file_path, file_size, require_file=preallocate)
+    max_parallels = max_parallels or HttpSession.pool_size
+    if preallocate:
+        if journal.ranges and os.path.getsize(file_path) == file_size:
+            print(f"resume {file_name}, {journal.completed_bytes()}/{file_size} bytes already downloaded")
+        else:
+            journal.reset()
+            try:
+                _preallocate(file_path, file_size)
+            except OSError as e:
+                print(f"preallocate {file_name} failed with {e}")
+                return None
+        scheduler = RangeScheduler(journal.missing(), chunk_size, budget=budget, progress=progress)
+        file_time = time.monotonic()
+        hasher = StreamingHasher(file_path, done_ranges=journal.ranges)
+        print(f"starting to download {file_name} with {len(scheduler.pending)} ranges")
+        with ThreadPoolExecutor(max_workers=max_parallels, thread_name_prefix="download") as executor:
+            workers = [executor.submit(range_worker, mirrors, file_path, scheduler, journal, proxies, hasher)
+                       for _ in range(min(parallels, max_parallels))]
+            best_rate, last_received, last_time = 0, 0, time.time()
+            while not all(worker.done() for worker in workers):
+                wait(workers, timeout=2)
+                rate = (scheduler.received - last_received) / max(time.time() - last_time, 1e-3)
+                last_received, last_time = scheduler.received, time.time()
+                alive = sum(not worker.done() for worker in workers)
+                if progress is None:
+                    print(f"downloading {file_name}: {journal.completed_bytes() / file_size * 100:.2f}% "
+                          f"{rate / 1024 / 1024:.2f}MB/s with {alive} connections")
+                if rate > best_rate * 1.1 and alive < max_parallels and scheduler.has_work():
+                    workers.append(executor.submit(range_worker, mirrors, file_path, scheduler, journal, proxies,
+                                                   hasher))
+                best_rate = max(best_rate, rate)
+        seconds = time.monotonic() - file_time
+        if not scheduler.finished():
+            journal.flush()
+            print(f"download {file_name} failed, {file_size - journal.completed_bytes()} bytes missing")
+            DownloadMetrics.emit("file_failed", url, path=file_path, bytes=scheduler.received, seconds=seconds)
+            return None
+        DownloadMetrics.emit("file_done", url, path=file_path, bytes=scheduler.received, seconds=seconds,
+                             throughput=scheduler.received / seconds if seconds > 0 else 0.0)
+        journal.remove()
+        print(f"finished download {file_name}")
+        return _verify(file_path, hasher.hexdigest(file_size), sha256)
+    PART_SIZE = 160 * 1024 * 1024  # every part is 160M
+    tasks = [(file_path, start, min(start + PART_SIZE, file_size), url, proxies, journal)
+             for start in range(0, file_size, PART_SIZE)]
+    if journal.ranges:
+        print(f"resume {file_name}, {journal.completed_bytes()}/{file_size} bytes already downloaded")
     print(f"starting to download {file_name} with {len(tasks)} parts")
     with ThreadPoolExecutor(max_workers=parallels, thread_name_prefix="download") as executor:
         part_file_names = list(executor.map(part_download, tasks))
+    if None in part_file_names:
+        journal.flush()
+        print(f"download {file_name} failed, {part_file_names.count(None)}/{len(tasks)} parts failed")
+        return None
     print(f"finished download {file_name} with {len(tasks)} parts")
-    with open(file_path, 'rb') as f:
+    hash = hashlib.sha256()
+    with BufferPool.buffer() as buffer, open(file_path, 'wb') as f:
         for part_file_name in part_file_names:
             with open(part_file_name, 'rb') as part_file:
-                f.write(part_file.read())
-            os.remove(part_file_name)
-    return True
+                while size := part_file.readinto(buffer):
+                    hash.update(buffer[:size])
+                    f.write(buffer[:size])
+    for part_file_name in part_file_names:
+        os.remove(part_file_name)
+    journal.remove()
+    return _verify(file_path, hash.hexdigest(), sha256)
+
+
+def _verify(file_path: str, digest: str, sha256: str = None) -> str:
+    """下载得到的摘要与期望值不一致时删除文件并返回None，一致时记入摘要缓存"""
+    if sha256 is not None and digest != sha256:
+        print(f"sha256校验失败：{file_path} expect {sha256}, got {digest}")
+        os.remove(file_path)
+        return None
+    if DigestCache.record_downloads:
+        DigestCache.default().put(file_path, digest)
+    return digest
+
+
+def _preallocate(file_path: str, file_size: int):
+    """
+    用truncate创建file_size大小的稀疏目标文件；RESERVE_DISK_SPACE为True时再向文件系统申请全部磁盘空间，
+    空间不足时在下载开始前就失败，文件也更少碎片，没有posix_fallocate（Windows、macOS）或文件系统不支持时保留稀疏文件
+    """
+    with open(file_path, "wb") as f:
+        f.truncate(file_size)
+        if not RESERVE_DISK_SPACE or not hasattr(os, "posix_fallocate") or file_size == 0:
+            return
+        try:
+            os.posix_fallocate(f.fileno(), 0, file_size)
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                return
+            f.close()
+            os.remove(file_path)
+            raise
+
+
+def _pwrite(fd: int, data, offset: int):
+    """在offset处写入全部data，不移动共享的文件指针（无pwrite的平台退化为lseek+write）"""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def range_worker(url: Union[str, Mirrors], file_path: str, scheduler: RangeScheduler, journal: RangeJournal,
+                 proxies: dict = None, hasher: StreamingHasher = None):
+    """
+    不断从scheduler领取区间并直接写入预分配好的目标文件，每写完一块就记入续传日志并交给hasher
+    url为Mirrors时每个区间从其中选一个镜像下载，并把该区间的吞吐反馈给Mirrors
+    """
+    mirrors = url if isinstance(url, Mirrors) else Mirrors(url)
+    fd = os.open(file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    try:
+        while True:
+            with scheduler.budget:
+                if (task := scheduler.next()) is None:
+                    break
+                offset = task.start
+                url = mirrors.pick()
+                timer = TransferTimer(url, offset=offset)
+                try:
+                    with BufferPool.buffer(RateLimiter.chunk_size(url, 1024*1024)) as buffer, \
+                            _open_range(url, task.start, task.end, proxies) as r:
+                        while received := _readinto(r, buffer):
+                            timer.chunk(received, RateLimiter.consume(url, received))
+                            size = scheduler.advance(task, received)
+                            if size > 0:
+                                _pwrite(fd, buffer[:size], offset)
+                                journal.add(offset, offset + size)
+                                if hasher is not None:
+                                    hasher.update(offset, buffer[:size])
+                                offset += size
+                            if task.start >= task.end:
+                                break
+                    if task.start < task.end:
+                        raise IOError(f"range {offset}-{task.end} incomplete")
+                    scheduler.done(task)
+                    timer.finish("range_done", end=offset)
+                    mirrors.record(url, timer.bytes, time.monotonic() - timer.start)
+                except Exception as e:
+                    print(f"range_worker failed with {e}")
+                    scheduler.failed(task, offset)
+                    timer.finish("range_failed", end=offset, error=str(e))
+                    mirrors.failed(url)
+    finally:
+        os.close(fd)
 
 
 def part_download(params) -> str:
-    file_path, start, end, url, proxies = params
-    headers = {'Range': f'bytes={start}-{end}'}
+    """下载[start, end)区间到分段文件，已有的分段文件会从续传日志记录的位置继续下载"""
+    file_path, start, end, url, proxies, journal = params
     part_file_name = file_path + f"_{start}_{end}"
+    resume_from = start
+    if os.path.exists(part_file_name):
+        missing = journal.missing(start, end)
+        resume_from = missing[0][0] if missing else end
+        resume_from = min(resume_from, start + os.path.getsize(part_file_name))
+    if resume_from == end:
+        return part_file_name
+    timer = TransferTimer(url, offset=resume_from)
     try:
-        r = requests.get(url, headers=headers, stream=True, proxies=proxies)
-        r.raise_for_status()
-        with open(part_file_name, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=4*1024*1024):
-                f.write(chunk)
+        with BufferPool.buffer(RateLimiter.chunk_size(url, 4*1024*1024)) as buffer, \
+                _open_range(url, resume_from, end, proxies) as r, \
+                open(part_file_name, 'r+b' if resume_from > start else 'wb') as f:
+            f.seek(resume_from - start)
+            f.truncate()
+            offset = resume_from
+            while received := _readinto(r, buffer):
+                timer.chunk(received, RateLimiter.consume(url, received))
+                f.write(buffer[:received])
+                f.flush()
+                journal.add(offset, offset + received)
+                offset += received
+        timer.finish("range_done", end=end)
         return part_file_name
     except Exception as e:
         print(f"part_download failed with {e}")
+        timer.finish("range_failed", error=str(e))
         return None
 
 
-def download_from_url(base_dir: str, url: str, proxies: dict = None, chunk_size: int = 50*1024*1024) -> str:
-    """从url下载文件到base_dir目录"""
+def parse_filename(disposition: str) -> str:
+    """从Content-Disposition中解析文件名，解析失败返回None"""
+    disposition_split = disposition.split("=")
+    if len(disposition_split) <= 1 or disposition_split[0] != "attachment;filename":
+        return None
+    return disposition_split[1]
+
+
+def download_from_url(base_dir: str, url: str, proxies: dict = None, chunk_size: int = 50*1024*1024,
+                      progress: DownloadProgress = None, sha256: str = None) -> str:
+    """从url下载文件到base_dir目录，文件名取自Content-Disposition，给出sha256时校验边下载边计算的摘要"""
+    request_time = time.monotonic()
     try:
-        response = requests.get(url, stream=True, proxies=proxies, verify=False)
+        response = http_get(url, stream=True, proxies=proxies, verify=False)
         response.raise_for_status()
     except Exception as e:
         print(f"下载文件失败：url = {url} f{e}")
         traceback.print_exc()
+        DownloadMetrics.emit("file_failed", url, error=str(e))
         return None
-    disposition_split = response.headers.get("Content-Disposition", "").split("=")
-    if len(disposition_split) <= 1:
-        print(f"获取文件名失败：Disposition = {disposition_split}, url = {url}")
-        return None
-    if disposition_split[0] == "attachment;filename":
-        filename = disposition_split[1]
-    else:
-        print(f"获取文件名失败：Disposition = {disposition_split}, url = {url}")
+    filename = parse_filename(response.headers.get("Content-Disposition", ""))
+    if filename is None:
+        print(f"获取文件名失败：Disposition = {response.headers.get('Content-Disposition')}, url = {url}")
         return None
+    result = _stream_download(response, url, os.path.join(base_dir, filename), proxies, chunk_size, progress, sha256,
+                              request_time)
+    return None if result is None else result.path
+
+
+def _stream_download(response: requests.Response, url: str, file_path: str, proxies: dict = None,
+                     chunk_size: int = 50*1024*1024, progress: DownloadProgress = None,
+                     sha256: str = None, request_time: float = None) -> DownloadResult:
+    """
+    把response单流写入file_path并同步计算sha256，存在续传日志时关闭response，只用Range请求下载缺失的部分
+    数据读入BufferPool借来的缓冲区，chunk_size只是单次读取的上限，实际不超过BufferPool.buffer_size
+    request_time为发出请求时的time.monotonic()，用于统计首字节时间
+    """
+    filename = os.path.basename(file_path)
     file_size = int(response.headers["Content-Length"])
     h_size = file_size / 1024 / 1024 / 1024
-    chunk_num = (file_size - 1) // chunk_size + 1
-    cur_chunk = 0
-    file_path = os.path.join(base_dir, filename)
+    BlobStore.detach(file_path)
+    journal = RangeJournal.load(file_path, file_size, response.headers.get("ETag"))
+    done_size = journal.completed_bytes()
+    hasher = StreamingHasher(file_path, done_ranges=journal.ranges)
+    resume = len(journal.ranges) > 0
+    if resume:
+        response.close()
+        print(f"resume <{filename}> from {done_size}/{file_size} bytes")
+    else:
+        journal.reset()
+    timer = TransferTimer(url, request_time, path=file_path)
     try:
-        with open(file_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                file.write(chunk)
-                cur_chunk += 1
-                print("Downloading <{}> size: {:.2f}GB: {}/{} - {:.2f}%: "
-                      .format(filename, h_size, cur_chunk, chunk_num, cur_chunk / chunk_num * 100),
-                      "▋" * (int(cur_chunk / chunk_num * 50)))
-                sys.stdout.flush()
-        print("Downloading <{}> file success. file size: {:.2f}GB.".format(file_path, h_size))
-        return file_path
+        with BufferPool.buffer(RateLimiter.chunk_size(url, chunk_size)) as buffer, \
+                open(file_path, "r+b" if resume else "wb") as file:
+            for start, end in journal.missing():
+                stream = _open_range(url, start, end, proxies) if resume else response
+                file.seek(start)
+                while received := _readinto(stream, buffer):
+                    timer.chunk(received, RateLimiter.consume(url, received))
+                    file.write(buffer[:received])
+                    file.flush()
+                    journal.add(start, start + received)
+                    hasher.update(start, buffer[:received])
+                    start += received
+                    done_size += received
+                    if progress is not None:
+                        progress.update(received)
+                        continue
+                    if int(done_size / file_size * 50) == int((done_size - received) / file_size * 50):
+                        continue
+                    print("Downloading <{}> size: {:.2f}GB: {:.2f}%: "
+                          .format(filename, h_size, done_size / file_size * 100),
+                          "▋" * (int(done_size / file_size * 50)))
+                    sys.stdout.flush()
+                if start != end:
+                    raise IOError(f"range {start}-{end} incomplete")
+        journal.remove()
+        digest = _verify(file_path, hasher.hexdigest(file_size), sha256)
+        if digest is None:
+            timer.finish("file_failed", error="sha256 mismatch")
+            return None
+        timer.finish("file_done")
+        if progress is None:
+            print("Downloading <{}> file success. file size: {:.2f}GB.".format(file_path, h_size))
+        return DownloadResult(file_path, digest)
     except Exception as e:
+        journal.flush()
         print(f"保存文件失败：filename = {filename}, url = {url} {e}")
         traceback.print_exc()
+        timer.finish("file_failed", error=str(e))
         return None
 
 
-def batch_download(base_dir: str, urls: List[str], proxies: dict = None, chunk_size: int = 50*1024*1024):
+def download_file(url: Union[str, List[str]], file_path: str, file_size: int = None, proxies: dict = None,
+                  budget: threading.Semaphore = None, progress: DownloadProgress = None,
+                  large_file_size: int = 64 * 1024 * 1024, sha256: str = None) -> DownloadResult:
+    """
+    下载url到指定路径file_path，大于large_file_size的文件拆成区间并行下载，其他文件单流下载并占用budget中的一个名额
+    返回路径和下载时计算出的sha256，给出sha256时校验不一致则下载失败，返回None
+    url为多个镜像上的等价url列表时，大文件的区间分散到各镜像，小文件从当前最快的镜像下载
+    """
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    if file_size is not None and file_size >= large_file_size:
+        digest = parallel_download(url, os.path.dirname(file_path), os.path.basename(file_path), file_size, proxies,
+                                   budget=budget, progress=progress, sha256=sha256)
+        return None if digest is None else DownloadResult(file_path, digest)
+    mirrors = Mirrors(url if sha256 is not None else Mirrors(url).urls[0])
+    if len(mirrors.urls) > 1 and file_size:
+        mirrors.probe(proxies)
+    url = mirrors.best()
+    with budget or nullcontext():
+        request_time = time.monotonic()
+        try:
+            response = http_get(url, stream=True, proxies=proxies, verify=False)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"下载文件失败：url = {url} {e}")
+            DownloadMetrics.emit("file_failed", url, path=file_path, error=str(e))
+            return None
+        return _stream_download(response, url, file_path, proxies, 4 * 1024 * 1024, progress, sha256, request_time)
+
+
+def download_files(tasks: List[tuple], proxies: dict = None, max_connections: int = 16,
+                   large_file_size: int = 64 * 1024 * 1024, blob_store: "BlobStore" = None,
+                   on_result: Callable[[int, DownloadResult], None] = None) -> List[DownloadResult]:
+    """
+    并发下载多个文件，tasks为(url, file_path, file_size, sha256)列表，file_size和sha256可以为None，url可以是等价的镜像url列表
+    所有文件和区间共享max_connections个连接的全局并发预算，返回与tasks一一对应的结果，下载失败或sha256校验不通过的为None
+    给出blob_store时，仓库中已有的内容直接链接过来，新下载的文件收入仓库；on_result在每个文件结束时以(任务下标, 结果)调用
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    budget = threading.Semaphore(max_connections)
+    progress = DownloadProgress(len(tasks), sum(task[2] or 0 for task in tasks))
+    if max_connections > HttpSession.pool_size:
+        HttpSession.configure(pool_size=max_connections)
+
+    def fetch(task) -> DownloadResult:
+        url, file_path, file_size, sha256 = task
+        if blob_store is not None and sha256 is not None and blob_store.link(sha256, file_path):
+            return DownloadResult(file_path, sha256)
+        result = download_file(url, file_path, file_size, proxies, budget, progress, large_file_size, sha256)
+        if result is not None and blob_store is not None:
+            blob_store.add(result.path, result.sha256)
+        if result is None:
+            print(f"download {url} to {file_path} failed")
+        return result
+
+    def run(index: int) -> DownloadResult:
+        result = fetch(tasks[index])
+        progress.file_done(result is not None)
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    # 大文件优先提交，让它们的区间尽早占满连接，小文件穿插在其中
+    order = sorted(range(len(tasks)), key=lambda i: -(tasks[i][2] or 0))
+    with ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="files") as executor:
+        futures = {i: executor.submit(run, i) for i in order}
+        while not all(future.done() for future in futures.values()):
+            wait(futures.values(), timeout=2)
+            progress.report()
+    DigestCache.flush_default()
+    return [futures[i].result() for i in range(len(tasks))]
+
+
+def batch_download(base_dir: str, urls: List[str], proxies: dict = None, chunk_size: int = 50*1024*1024,
+                   mode: str = "sequential", max_connections: int = 16):
+    """mode为sequential时逐个下载，为concurrent时最多max_connections个文件同时下载"""
+    from concurrent.futures import ThreadPoolExecutor, wait
     print(f'begin downloading {len(urls)} files ...')
     time_start = time.time()
-    for url in urls:
-        print_split()
-        download_from_url(base_dir, url, proxies, chunk_size)
+    if mode == "concurrent":
+        progress = DownloadProgress(len(urls))
+
+        def run(url: str):
+            progress.file_done(download_from_url(base_dir, url, proxies, chunk_size, progress) is not None)
+
+        with ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="files") as executor:
+            futures = [executor.submit(run, url) for url in urls]
+            while not all(future.done() for future in futures):
+                wait(futures, timeout=2)
+                progress.report()
+    else:
+        for url in urls:
+            print_split()
+            download_from_url(base_dir, url, proxies, chunk_size)
     time_end = time.time()
     seconds = time_end - time_start
     m, s = divmod(seconds, 60)
@@ -109,21 +1203,402 @@ def file_hash(file_path: str, method="sha256") -> str:
     if not os.path.isfile(file_path):
         print("file not exist: {}".format(file_path))
         return None
-    hash_method = {"sha256": hashlib.sha256, "sha512": hashlib.sha512, "md5": hashlib.md5, "sha1": hashlib.sha1}[method]
+    return file_hashes(file_path, [method])[method]
+
+
+def file_hashes(file_path: str, methods: List[str] = ("sha256",), buffer_size: int = 16*1024*1024) -> Dict[str, str]:
+    """
+    一次读取同时计算多种摘要：通过mmap直接把页缓存交给hashlib，不能mmap时退化为readinto复用同一个缓冲区
+    hashlib处理大块数据时会释放GIL，因此多个线程可以并行计算不同文件
+    """
+    hashes = {method: HASH_METHODS[method]() for method in methods}
     with open(file_path, "rb") as f:
-        hash = hash_method()
-        while chunk := f.read(1024*1024):
-            hash.update(chunk)
-        return hash.hexdigest()
+        file_size = os.fstat(f.fileno()).st_size
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size > 0 else None
+        except (OSError, ValueError):
+            mm = None
+        if mm is not None:
+            with mm, memoryview(mm) as view:
+                for offset in range(0, file_size, buffer_size):
+                    with view[offset:offset + buffer_size] as chunk:
+                        for hash in hashes.values():
+                            hash.update(chunk)
+        else:
+            buffer = bytearray(buffer_size)
+            with memoryview(buffer) as view:
+                while size := f.readinto(buffer):
+                    with view[:size] as chunk:
+                        for hash in hashes.values():
+                            hash.update(chunk)
+    return {method: hash.hexdigest() for method, hash in hashes.items()}
+
+
+def hash_files(file_paths: List[str], methods: List[str] = ("sha256",), workers: int = None,
+               use_processes: bool = False) -> Dict[str, Dict[str, str]]:
+    """
+    并发计算多个文件的摘要，返回{file_path: {method: digest}}，读取失败的文件不在结果中
+    默认使用线程池；use_processes=True时使用进程池，适合同时计算多种摘要、CPU成为瓶颈的场景
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    workers = workers or min(32, os.cpu_count() or 1)
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    results = {}
+    total_size = 0
+    time_start = time.time()
+    with executor_cls(max_workers=workers) as executor:
+        futures = {executor.submit(file_hashes, file_path, list(methods)): file_path for file_path in file_paths}
+        for future, file_path in futures.items():
+            try:
+                results[file_path] = future.result()
+                total_size += os.path.getsize(file_path)
+            except Exception as e:
+                print(f"计算摘要失败：{file_path} {e}")
+    seconds = max(time.time() - time_start, 1e-6)
+    print(f"hashed {len(results)} files, {total_size / 1024 / 1024 / 1024:.2f}GB in {seconds:.2f}s, "
+          f"{total_size / 1024 / 1024 / seconds:.2f}MB/s")
+    return results
+
+
+class DigestCache:
+
+    """
+    本地文件摘要缓存，以(path, size, mtime_ns, inode)为键，文件没有变化时直接返回保存的sha256，文件变化后自动失效
+    put只修改内存中的条目，flush时才整体写回磁盘：距上次写入超过save_interval秒的put会顺带写一次，
+    批量操作结束时和进程退出时也会写入；record_downloads为False时下载完成的文件不记入默认缓存（临时文件、代理缓存等）
+    """
+
+    default_path = os.path.join(os.path.expanduser("~"), ".cache", "my-tools", "file_digests.json")
+    save_interval = 30
+    record_downloads = True
+    _default = None
+    _lock = threading.Lock()
+
+    def __init__(self, path: str = None):
+        self.path = path or self.default_path
+        self.entries = {}
+        self.dirty = False
+        self.saved_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"读取摘要缓存失败：{self.path} {e}")
+
+    @classmethod
+    def default(cls) -> "DigestCache":
+        # 多个下载线程会同时调用，加锁保证只加载一个实例，否则各自的atexit flush会互相覆盖对方的条目
+        if cls._default is None:
+            with cls._lock:
+                if cls._default is None:
+                    import atexit
+                    cache = cls()
+                    atexit.register(cache.flush)
+                    cls._default = cache
+        return cls._default
+
+    @classmethod
+    def flush_default(cls):
+        """默认缓存已经加载时把修改写回磁盘"""
+        if cls._default is not None:
+            cls._default.flush()
+
+    @staticmethod
+    def _key(stat: os.stat_result) -> list:
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get(self, file_path: str) -> str:
+        file_path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(file_path)
+        if entry is None or entry["key"] != self._key(stat):
+            return None
+        return entry["sha256"]
+
+    def put(self, file_path: str, sha256: str, stat: os.stat_result = None):
+        file_path = os.path.abspath(file_path)
+        stat = stat or os.stat(file_path)
+        with self.lock:
+            self.entries[file_path] = {"key": self._key(stat), "sha256": sha256}
+            self.dirty = True
+            due = time.monotonic() - self.saved_time >= self.save_interval
+        if due:
+            self.flush()
+
+    def file_hash(self, file_path: str) -> str:
+        """返回文件的sha256，缓存失效时重新计算并更新缓存"""
+        digest = self.get(file_path)
+        if digest is not None or not os.path.isfile(file_path):
+            return digest
+        stat = os.stat(file_path)
+        digest = file_hash(file_path)
+        if self._key(os.stat(file_path)) == self._key(stat):
+            self.put(file_path, digest, stat)
+        return digest
+
+    def flush(self):
+        """把修改写回磁盘，没有修改时什么都不做；序列化在快照上进行，不阻塞并发的get/put"""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries, self.dirty, self.saved_time = dict(self.entries), False, time.monotonic()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+
+    def rebuild(self, directory: str, workers: int = None) -> int:
+        """并发重新计算directory下所有文件的摘要，返回文件数"""
+        file_paths = [os.path.join(root, name) for root, _, files in os.walk(directory)
+                      for name in files if not name.endswith(".journal")]
+        stats = {file_path: os.stat(file_path) for file_path in file_paths}
+        digests = hash_files(file_paths, workers=workers)
+        for file_path, digest in digests.items():
+            if self._key(os.stat(file_path)) == self._key(stats[file_path]):
+                self.put(file_path, digest["sha256"], stats[file_path])
+        self.flush()
+        return len(digests)
+
+    def verify(self, directory: str = None) -> List[str]:
+        """重新计算缓存中（directory下）文件的摘要，删除已不存在或已变化的条目，返回摘要不一致的文件"""
+        prefix = None if directory is None else os.path.join(os.path.abspath(directory), "")
+        mismatched = []
+        for file_path, entry in list(self.entries.items()):
+            if prefix is not None and not file_path.startswith(prefix):
+                continue
+            if self.get(file_path) is None:
+                with self.lock:
+                    self.entries.pop(file_path, None)
+                    self.dirty = True
+                continue
+            if file_hash(file_path) != entry["sha256"]:
+                mismatched.append(file_path)
+                with self.lock:
+                    self.entries.pop(file_path, None)
+                    self.dirty = True
+        self.flush()
+        return mismatched
+
+
+class BlobStore:
+
+    """
+    按sha256寻址的本地blob仓库，相同内容在所有模型、版本之间只下载和存储一次
+    模型目录中的文件是指向blob的硬链接，不能硬链接（如跨文件系统）时用符号链接；
+    总大小超过max_bytes时，按最近使用时间淘汰已不被任何模型目录引用的blob
+    """
+
+    def __init__(self, root: str, max_bytes: int = None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, "index.json")
+        self.index = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def has(self, sha256: str) -> bool:
+        return os.path.isfile(self.blob_path(sha256))
+
+    @staticmethod
+    def detach(file_path: str):
+        """
+        file_path是符号链接或有多个硬链接时先删除，再写入的内容落到新文件里；
+        所有原地写入file_path的下载函数都要先调用，否则新版本的内容会写穿到仓库中的blob，破坏其他模型引用的文件
+        """
+        if os.path.islink(file_path) or os.path.isfile(file_path) and os.stat(file_path).st_nlink > 1:
+            os.remove(file_path)
+
+    def link(self, sha256: str, file_path: str) -> bool:
+        """把blob链接到file_path，blob不存在时返回False"""
+        if not self.has(sha256):
+            return False
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        if os.path.lexists(file_path):
+            if os.path.exists(file_path) and os.path.samefile(file_path, self.blob_path(sha256)):
+                self._touch(sha256, file_path)
+                return True
+            os.remove(file_path)
+        try:
+            os.link(self.blob_path(sha256), file_path)
+        except OSError:
+            os.symlink(os.path.abspath(self.blob_path(sha256)), file_path)
+        self._touch(sha256, file_path)
+        return True
+
+    def add(self, file_path: str, sha256: str):
+        """把刚下载的文件收入仓库；内容已存在时把file_path换成指向已有blob的链接"""
+        if self.has(sha256):
+            self.link(sha256, file_path)
+            return
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(file_path, blob_path)
+        except OSError:
+            shutil.move(file_path, blob_path)
+            os.symlink(os.path.abspath(blob_path), file_path)
+        self._touch(sha256, file_path)
+        self.evict()
+
+    def _touch(self, sha256: str, file_path: str):
+        with self.lock:
+            entry = self.index.setdefault(sha256, {"links": []})
+            entry["last_used"] = time.time()
+            entry["size"] = os.path.getsize(self.blob_path(sha256))
+            file_path = os.path.abspath(file_path)
+            if file_path not in entry["links"]:
+                entry["links"].append(file_path)
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _referenced(self, sha256: str) -> bool:
+        blob_path = self.blob_path(sha256)
+        if os.stat(blob_path).st_nlink > 1:
+            return True
+        return any(os.path.exists(link) and os.path.samefile(link, blob_path)
+                   for link in self.index.get(sha256, {}).get("links", []))
+
+    def evict(self):
+        """总大小超过max_bytes时，从最久未使用的开始删除不再被引用的blob"""
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            total_size = sum(entry.get("size", 0) for entry in self.index.values())
+            for sha256, entry in sorted(self.index.items(), key=lambda item: item[1].get("last_used", 0)):
+                if total_size <= self.max_bytes:
+                    break
+                if not self.has(sha256):
+                    total_size -= entry.get("size", 0)
+                    del self.index[sha256]
+                elif not self._referenced(sha256):
+                    os.remove(self.blob_path(sha256))
+                    total_size -= entry.get("size", 0)
+                    del self.index[sha256]
+            self._save()
+
+
+class ManifestCache:
+
+    """
+    按(来源, 仓库, 版本)缓存的文件清单：保存文件路径、大小、sha256和ETag，通过If-None-Match条件请求刷新；
+    同时记录上次同步成功的文件，重新同步时只传输新增或变化的文件
+    """
+
+    default_root = os.path.join(os.path.expanduser("~"), ".cache", "my-tools", "manifests")
+
+    def __init__(self, root: str = None):
+        self.root = root or self.default_root
+        self.lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *[quote(part, safe="") for part in key.split("/")]) + ".json"
+
+    def load(self, key: str) -> dict:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取清单缓存失败：{path} {e}")
+            return {}
+
+    def save(self, key: str, entry: dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def fetch(self, key: str, url: str, parse, proxies: dict = None):
+        """带If-None-Match请求url，服务端返回304时直接使用缓存的清单，否则用parse解析新的响应并缓存"""
+        entry = self.load(key)
+        headers = {"If-None-Match": entry["etag"]} if entry.get("etag") and "data" in entry else {}
+        response = http_get(url, headers=headers, proxies=proxies, verify=False)
+        if response.status_code == 304:
+            return entry["data"]
+        response.raise_for_status()
+        entry.update(etag=response.headers.get("ETag"), data=parse(response.json()), time=time.time())
+        self.save(key, entry)
+        return entry["data"]
+
+    @staticmethod
+    def _identity(file: dict) -> list:
+        return [file.get("size"), file.get("sha256"), file.get("etag")]
+
+    def diff(self, key: str, files: List[dict], base_dir: str) -> List[dict]:
+        """返回相对上次同步新增或变化的文件；上次同步过、清单未变且本地文件大小一致的文件被跳过"""
+        synced = self.load(key + "/synced").get("files", {})
+        changed = []
+        for file in files:
+            local_file_path = os.path.join(base_dir, file["path"])
+            if synced.get(file["path"]) == self._identity(file) and os.path.isfile(local_file_path) and \
+                    (file.get("size") is None or os.path.getsize(local_file_path) == file["size"]):
+                continue
+            changed.append(file)
+        return changed
+
+    def mark_synced(self, key: str, files: List[dict]):
+        with self.lock:
+            entry = self.load(key + "/synced")
+            entry.setdefault("files", {}).update({file["path"]: self._identity(file) for file in files})
+            entry["time"] = time.time()
+            self.save(key + "/synced", entry)
+
+
+def match_path(path: str, include: List[str] = None, exclude: List[str] = None) -> bool:
+    """按glob过滤仓库中的文件路径：include为空时保留全部，同时匹配include和exclude时排除"""
+    from fnmatch import fnmatch
+    return (not include or any(fnmatch(path, pattern) for pattern in include)) and \
+        not any(fnmatch(path, pattern) for pattern in exclude or ())
+
+
+def _fetch_listing(url: str, parse, proxies: dict = None, manifest_cache: ManifestCache = None, key: str = None):
+    if manifest_cache is not None:
+        return manifest_cache.fetch(key, url, parse, proxies)
+    response = http_get(url, proxies=proxies, verify=False)
+    response.raise_for_status()
+    return parse(response.json())
 
 
 class HuggingFace:
 
     """
-    Hugging Face 无sha校验
+    Hugging Face 只有LFS文件带sha256，下载时边下载边校验
+    mirrors为与endpoint等价的其他端点（镜像、内部缓存），concurrent模式下带sha256的文件会同时从这些端点下载
     """
 
     endpoint = "https://huggingface.co"
+    mirrors: List[str] = []
+
+    @classmethod
+    def file_url(cls, repo_id: str, revision: str, path: str, sha256: str = None) -> Union[str, List[str]]:
+        """文件的下载地址，配置了mirrors且有sha256可以校验时返回各端点上的等价url列表"""
+        urls = [f"{endpoint}/{repo_id}/resolve/{quote(revision,safe='')}/{quote(path)}"
+                for endpoint in [cls.endpoint] + cls.mirrors]
+        return urls if sha256 is not None and len(urls) > 1 else urls[0]
 
     @classmethod
     def get_files(cls, repo_id: str, revision: str = "main", proxies: Dict = None) -> List[str]:
@@ -133,7 +1608,7 @@ class HuggingFace:
             else f"{cls.endpoint}/api/models/{repo_id}/revision/{quote(revision,safe='')}"
         )
         try:
-            response = requests.get(url, proxies=proxies, verify=False)
+            response = http_get(url, proxies=proxies, verify=False)
             response.raise_for_status()
             resp_json = response.json()
             return [file["rfilename"] for file in resp_json["siblings"]]
@@ -143,21 +1618,56 @@ class HuggingFace:
             return []
 
     @classmethod
-    def download_model(cls, repo_id: str, base_dir: str, proxies: dict = None, revision: str = "main"):
+    def get_file_metas(cls, repo_id: str, revision: str = "main", proxies: Dict = None,
+                       manifest_cache: ManifestCache = None) -> List[dict]:
+        """获取文件列表及大小，LFS文件附带sha256，etag为文件的blob id；给出manifest_cache时使用条件请求"""
+        url = f"{cls.endpoint}/api/models/{repo_id}/revision/{quote(revision,safe='')}?blobs=true"
+        try:
+            return _fetch_listing(url, lambda resp_json: [
+                {"path": _["rfilename"], "size": _.get("size"), "sha256": (_.get("lfs") or {}).get("sha256"),
+                 "etag": _.get("blobId")} for _ in resp_json["siblings"]
+            ], proxies, manifest_cache, f"huggingface/{repo_id}/{revision}")
+        except Exception as e:
+            print(f"获取文件列表失败：url = {url} {e}")
+            traceback.print_exc()
+            return []
+
+    @classmethod
+    def download_model(cls, repo_id: str, base_dir: str, proxies: dict = None, revision: str = "main",
+                       mode: str = "concurrent", max_connections: int = 16, blob_store: BlobStore = None,
+                       manifest_cache: ManifestCache = None, include: List[str] = None, exclude: List[str] = None):
+        """
+        mode为sequential时逐个文件下载；为concurrent时所有文件共享max_connections个连接并发下载，大文件拆成区间
+        concurrent模式下给出blob_store时，模型目录中的文件链接到按sha256去重的blob仓库；
+        给出manifest_cache时，文件清单用条件请求刷新，只下载相对上次同步新增或变化的文件
+        include/exclude为文件路径的glob列表，例如exclude=["*.bin", "*.pth"]只下载safetensors格式的权重
+        """
         base_dir = os.path.join(base_dir, repo_id)
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
         print(f"begin download model {repo_id} revision {revision} from Hugging Face!")
-        files = cls.get_files(repo_id, revision, proxies)
         time_start = time.time()
-        success_cnt = 0
-        for file in files:
-            print_split()
-            url = f"{cls.endpoint}/{repo_id}/resolve/{quote(revision,safe='')}/{quote(file)}"
-            if download_from_url(base_dir, url, proxies=proxies) is not None:
-                success_cnt += 1
-            else:
-                print(f"download file {file} in {repo_id} from Hugging Face failed. base_dir = {base_dir}")
+        if mode == "concurrent":
+            files = [file for file in cls.get_file_metas(repo_id, revision, proxies, manifest_cache)
+                     if match_path(file["path"], include, exclude)]
+            key = f"huggingface/{repo_id}/{revision}"
+            changed = files if manifest_cache is None else manifest_cache.diff(key, files, base_dir)
+            tasks = [(cls.file_url(repo_id, revision, file["path"], file["sha256"]),
+                      os.path.join(base_dir, file["path"]), file["size"], file["sha256"]) for file in changed]
+            results = download_files(tasks, proxies, max_connections, blob_store=blob_store)
+            success_cnt = len(files) - len(changed) + sum(result is not None for result in results)
+            if manifest_cache is not None:
+                manifest_cache.mark_synced(key, [file for file, result in zip(changed, results) if result is not None])
+        else:
+            files = [file for file in cls.get_files(repo_id, revision, proxies) if match_path(file, include, exclude)]
+            success_cnt = 0
+            for file in files:
+                print_split()
+                url = cls.file_url(repo_id, revision, file)
+                if download_from_url(base_dir, url, proxies=proxies) is not None:
+                    success_cnt += 1
+                else:
+                    print(f"download file {file} in {repo_id} from Hugging Face failed. base_dir = {base_dir}")
         m, s = divmod(time.time() - time_start, 60)
         h, m = divmod(m, 60)
         print(
@@ -170,66 +1680,294 @@ class ModelScope:
 
     """
     Model Scope 校验sha避免重复下载
+    mirrors为与base_url等价的其他端点，concurrent模式下文件会同时从这些端点下载
     """
     base_url = "https://modelscope.cn/api/v1/models"
+    mirrors: List[str] = []
+
+    @classmethod
+    def file_url(cls, repo_id: str, revision: str, path: str, sha256: str = None) -> Union[str, List[str]]:
+        """文件的下载地址，配置了mirrors且有sha256可以校验时返回各端点上的等价url列表"""
+        urls = [f"{base_url}/{repo_id}/repo?Revision={revision}&FilePath={path}"
+                for base_url in [cls.base_url] + cls.mirrors]
+        return urls if sha256 is not None and len(urls) > 1 else urls[0]
 
     @classmethod
-    def get_revisions(cls, model_name: str, proxies: dict = None) -> List[str]:
+    def get_revisions(cls, model_name: str, proxies: dict = None, manifest_cache: ManifestCache = None) -> List[str]:
         url = f"{cls.base_url}/{model_name}/revisions"
         try:
-            response = requests.get(url, proxies=proxies, verify=False)
-            response.raise_for_status()
-            resp_json = response.json()
-            return [revision["Revision"] for revision in resp_json["Data"]["RevisionMap"]["Branches"]]
+            return _fetch_listing(url, lambda resp_json: [
+                revision["Revision"] for revision in resp_json["Data"]["RevisionMap"]["Branches"]
+            ], proxies, manifest_cache, f"modelscope/{model_name}/revisions")
         except Exception as e:
             print(f"获取版本列表失败：url = {url} {e}")
             traceback.print_exc()
             return []
 
     @classmethod
-    def get_files(cls, model_name: str, revision: str, proxies: dict = None) -> List[str]:
+    def get_files(cls, model_name: str, revision: str, proxies: dict = None,
+                  manifest_cache: ManifestCache = None) -> List[dict]:
         url = f"{cls.base_url}/{model_name}/repo/files?Revision={revision}&Root="
         try:
-            response = requests.get(url, proxies=proxies, verify=False)
-            response.raise_for_status()
-            resp_json = response.json()
-            return [{"path": _["Path"], "sha256": _["Sha256"]} for _ in resp_json["Data"]["Files"]]
+            return _fetch_listing(url, lambda resp_json: [
+                {"path": _["Path"], "sha256": _["Sha256"], "size": _.get("Size")} for _ in resp_json["Data"]["Files"]
+            ], proxies, manifest_cache, f"modelscope/{model_name}/{revision}")
         except Exception as e:
             print(f"获取文件列表失败：url = {url} {e}")
             traceback.print_exc()
             return []
 
     @classmethod
-    def download_model(cls, repo_id: str, base_dir: str, proxies: dict = None, chunk_size: int = 50 * 1024 * 1024):
+    def download_model(cls, repo_id: str, base_dir: str, proxies: dict = None, chunk_size: int = 50 * 1024 * 1024,
+                       mode: str = "concurrent", max_connections: int = 16, blob_store: BlobStore = None,
+                       manifest_cache: ManifestCache = None, include: List[str] = None, exclude: List[str] = None):
+        """
+        mode为sequential时逐个文件下载；为concurrent时所有文件共享max_connections个连接并发下载，大文件拆成区间
+        concurrent模式下给出blob_store时，模型目录中的文件链接到按sha256去重的blob仓库；
+        给出manifest_cache时，版本和文件清单用条件请求刷新，只检查和下载相对上次同步新增或变化的文件
+        include/exclude为文件路径的glob列表，只下载匹配include且不匹配exclude的文件
+        """
         base_dir = os.path.join(base_dir, repo_id)
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
         print(f"begin download model {repo_id} from model scope!")
-        revisions = cls.get_revisions(repo_id, proxies)
+        revisions = cls.get_revisions(repo_id, proxies, manifest_cache)
         if len(revisions) == 0:
             print(f"没有找到版本列表：model_name = {repo_id}")
             return
         revision = revisions[0]
         print(f"使用版本：{revision}")
-        files = cls.get_files(repo_id, revision, proxies)
+        files = [file for file in cls.get_files(repo_id, revision, proxies, manifest_cache)
+                 if match_path(file["path"], include, exclude)]
         if len(files) == 0:
             print(f"没有文件列表：model_name = {repo_id}, revision = {revision}")
             return
         time_start = time.time()
-        success_cnt = 0
-        for file in files:
-            print_split()
+        key = f"modelscope/{repo_id}/{revision}"
+        changed = files if manifest_cache is None else manifest_cache.diff(key, files, base_dir)
+        success_cnt = len(files) - len(changed)
+        synced = []
+        tasks = []
+        for file in changed:
             file_path, hash = file["path"], file["sha256"]
             local_file_path = os.path.join(base_dir, file_path)
-            if os.path.exists(local_file_path) and file_hash(local_file_path) == hash:
+            if os.path.exists(local_file_path) and DigestCache.default().file_hash(local_file_path) == hash:
                 success_cnt += 1
+                synced.append(file)
                 continue
-            url = f"{cls.base_url}/{repo_id}/repo?Revision={revision}&FilePath={file_path}"
-            if download_from_url(base_dir, url, proxies, chunk_size) is not None:
+            url = cls.file_url(repo_id, revision, file_path)
+            if mode == "concurrent":
+                tasks.append((file, (cls.file_url(repo_id, revision, file_path, hash), local_file_path, file["size"],
+                                     hash)))
+                continue
+            print_split()
+            if download_from_url(base_dir, url, proxies, chunk_size, sha256=hash) is not None:
                 success_cnt += 1
+                synced.append(file)
+        if tasks:
+            results = download_files([task for _, task in tasks], proxies, max_connections, blob_store=blob_store)
+            synced += [file for (file, _), result in zip(tasks, results) if result is not None]
+            success_cnt += sum(result is not None for result in results)
+        if manifest_cache is not None:
+            manifest_cache.mark_synced(key, synced)
         m, s = divmod(time.time() - time_start, 60)
         h, m = divmod(m, 60)
         print(
             f"{success_cnt}/{len(files)} file download completed, cost time: {int(h):0>d}h {int(m):0>2d}m {int(s):0>2d}s"
         )
         print(f"success download model {repo_id} from model scope!")
+
+
+class JobQueue:
+
+    """
+    清单驱动的批量下载。manifest为JSON任务列表，每个任务为
+        {"source": "huggingface" | "modelscope", "repo": "org/name", "revision": "main", "include": [...], "exclude": [...]}
+        {"source": "url", "url": "...", "path": "相对base_dir的保存路径", "sha256": "...", "size": ...}
+    revision、include、exclude、path、sha256、size都可以省略，ModelScope省略revision时使用第一个分支
+    任务状态保存在state文件中，已完成的文件记录在manifest_cache的同步状态里：中断后重新运行会跳过已完成的任务和文件，
+    未完成的文件从续传日志继续。所有任务的文件放进同一个download_files，共享max_connections个连接
+    """
+
+    def __init__(self, manifest_path: str, base_dir: str, state_path: str = None, max_connections: int = 16,
+                 proxies: dict = None, blob_store: BlobStore = None, manifest_cache: ManifestCache = None):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            self.jobs = json.load(f)
+        self.base_dir = base_dir
+        self.state_path = state_path or manifest_path + ".state.json"
+        self.max_connections = max_connections
+        self.proxies = proxies
+        self.blob_store = blob_store
+        self.manifest_cache = manifest_cache or ManifestCache()
+        self.state = {"jobs": {}}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def job_key(job: dict) -> str:
+        if job["source"] == "url":
+            return f"url/{job['url']}"
+        return f"{job['source']}/{job['repo']}" + (f"@{job['revision']}" if job.get("revision") else "")
+
+    def _save(self):
+        with self.lock:
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+    def _resolve(self, job: dict) -> tuple:
+        """返回(同步状态的key, 本地目录, 带url的文件清单)"""
+        source, revision = job["source"], job.get("revision")
+        if source == "huggingface":
+            revision = revision or "main"
+            files = HuggingFace.get_file_metas(job["repo"], revision, self.proxies, self.manifest_cache)
+            for file in files:
+                file["url"] = HuggingFace.file_url(job["repo"], revision, file["path"], file["sha256"])
+        elif source == "modelscope":
+            if revision is None:
+                revisions = ModelScope.get_revisions(job["repo"], self.proxies, self.manifest_cache)
+                if not revisions:
+                    raise IOError(f"no revision found for {job['repo']}")
+                revision = revisions[0]
+            files = ModelScope.get_files(job["repo"], revision, self.proxies, self.manifest_cache)
+            for file in files:
+                file["url"] = ModelScope.file_url(job["repo"], revision, file["path"], file["sha256"])
+        elif source == "url":
+            path = job.get("path") or os.path.basename(urlsplit(job["url"]).path)
+            return f"url/{job['url']}", self.base_dir, [{"path": path, "size": job.get("size"),
+                                                          "sha256": job.get("sha256"), "url": job["url"]}]
+        else:
+            raise ValueError(f"unknown source {source}")
+        if not files:
+            raise IOError(f"empty file list for {job['repo']} revision {revision}")
+        return f"{source}/{job['repo']}/{revision}", os.path.join(self.base_dir, job["repo"]), files
+
+    def run(self, retry_done: bool = False) -> bool:
+        """运行所有未完成的任务（retry_done=True时包括已完成的任务），全部成功返回True"""
+        time_start = time.time()
+        tasks, owners, summary = [], [], {}
+        for job in self.jobs:
+            key = self.job_key(job)
+            entry = self.state["jobs"].setdefault(key, {"status": "pending"})
+            if entry["status"] == "done" and not retry_done:
+                summary[key] = {"status": "done", "selected": 0, "skipped": 0, "downloaded": 0, "failed": 0, "bytes": 0}
+                continue
+            try:
+                sync_key, base_dir, files = self._resolve(job)
+            except Exception as e:
+                print(f"resolve job {key} failed with {e}")
+                entry.update(status="failed", error=str(e))
+                summary[key] = {"status": "failed", "selected": 0, "skipped": 0, "downloaded": 0, "failed": 0,
+                                "bytes": 0}
+                continue
+            selected = [file for file in files if match_path(file["path"], job.get("include"), job.get("exclude"))]
+            changed = self.manifest_cache.diff(sync_key, selected, base_dir)
+            summary[key] = {"status": "running", "selected": len(selected), "total": len(files),
+                            "skipped": len(selected) - len(changed), "downloaded": 0, "failed": 0, "bytes": 0}
+            for file in changed:
+                tasks.append((file["url"], os.path.join(base_dir, file["path"]), file["size"], file["sha256"]))
+                owners.append((key, sync_key, file))
+        self._save()
+
+        def on_result(index: int, result: DownloadResult):
+            key, sync_key, file = owners[index]
+            with self.lock:
+                if result is None:
+                    summary[key]["failed"] += 1
+                    return
+                summary[key]["downloaded"] += 1
+                summary[key]["bytes"] += file["size"] or os.path.getsize(result.path)
+            self.manifest_cache.mark_synced(sync_key, [file])
+
+        print(f"{len(tasks)} files to download for {len(summary)} jobs")
+        if tasks:
+            download_files(tasks, self.proxies, self.max_connections, blob_store=self.blob_store, on_result=on_result)
+        for key, stats in summary.items():
+            if stats["status"] == "running":
+                stats["status"] = "failed" if stats["failed"] else "done"
+                self.state["jobs"][key].update(status=stats["status"], time=time.time(),
+                                               error=f"{stats['failed']} files failed" if stats["failed"] else None)
+        self._save()
+        self.print_summary(summary, time.time() - time_start)
+        return all(stats["status"] == "done" for stats in summary.values())
+
+    @staticmethod
+    def print_summary(summary: Dict[str, dict], seconds: float):
+        print_split()
+        print(f"{'job':<60} {'status':>7} {'files':>11} {'skipped':>8} {'new':>6} {'failed':>7} {'GB':>8}")
+        for key, stats in summary.items():
+            files = f"{stats['selected']}/{stats.get('total', stats['selected'])}"
+            print(f"{key:<60} {stats['status']:>7} {files:>11} {stats['skipped']:>8} {stats['downloaded']:>6} "
+                  f"{stats['failed']:>7} {stats['bytes'] / 1024 / 1024 / 1024:>8.2f}")
+        total_bytes = sum(stats["bytes"] for stats in summary.values())
+        failed_jobs = sum(stats["status"] == "failed" for stats in summary.values())
+        print(f"{len(summary) - failed_jobs}/{len(summary)} jobs done, {total_bytes / 1024 / 1024 / 1024:.2f}GB in "
+              f"{seconds:.0f}s ({total_bytes / 1024 / 1024 / max(seconds, 1e-3):.2f}MB/s)")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="model and file downloader")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    digest_parser = subparsers.add_parser("digest", help="rebuild or verify the local file digest cache")
+    digest_parser.add_argument("action", choices=["rebuild", "verify"])
+    digest_parser.add_argument("dirs", nargs="*", help="directories to rebuild/verify, verify all entries if empty")
+    digest_parser.add_argument("--cache", default=DigestCache.default_path, help="digest cache file")
+    hash_parser = subparsers.add_parser("hash", help="hash files concurrently and report throughput")
+    hash_parser.add_argument("paths", nargs="+", help="files or directories")
+    hash_parser.add_argument("--method", action="append", choices=list(HASH_METHODS),
+                             help="digest method, can be repeated, default sha256")
+    hash_parser.add_argument("--workers", type=int, default=None)
+    hash_parser.add_argument("--processes", action="store_true", help="use a process pool instead of threads")
+    proxy_parser = subparsers.add_parser("proxy", help="run a local caching proxy for Hugging Face and ModelScope files")
+    proxy_parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "my-tools", "proxy"))
+    proxy_parser.add_argument("--host", default="127.0.0.1")
+    proxy_parser.add_argument("--port", type=int, default=8090)
+    proxy_parser.add_argument("--ttl", type=float, default=600, help="seconds before a cached file is revalidated")
+    proxy_parser.add_argument("--parallels", type=int, default=4, help="connections per upstream fetch")
+    proxy_parser.add_argument("--hf-endpoint", default=HuggingFace.endpoint)
+    proxy_parser.add_argument("--modelscope-url", default=ModelScope.base_url)
+    sync_parser = subparsers.add_parser("sync", help="download the jobs listed in a manifest with a restartable queue")
+    sync_parser.add_argument("manifest", help="JSON list of jobs, see JobQueue")
+    sync_parser.add_argument("--base-dir", default=".")
+    sync_parser.add_argument("--state", default=None, help="job state file, default <manifest>.state.json")
+    sync_parser.add_argument("--max-connections", type=int, default=16, help="connections shared by all jobs")
+    sync_parser.add_argument("--blob-store", default=None, help="directory of a content-addressed blob store")
+    sync_parser.add_argument("--retry-done", action="store_true", help="check jobs that already finished again")
+    args = parser.parse_args()
+    if args.command == "sync":
+        queue = JobQueue(args.manifest, args.base_dir, args.state, args.max_connections,
+                         blob_store=BlobStore(args.blob_store) if args.blob_store else None)
+        if not queue.run(args.retry_done):
+            sys.exit(1)
+    elif args.command == "proxy":
+        import download_proxy
+        download_proxy.HuggingFace.endpoint = args.hf_endpoint
+        download_proxy.ModelScope.base_url = args.modelscope_url
+        download_proxy.serve(args.cache_dir, args.host, args.port, ttl=args.ttl, parallels=args.parallels)
+    elif args.command == "hash":
+        file_paths = [os.path.join(root, name) for path in args.paths
+                      for root, _, files in (os.walk(path) if os.path.isdir(path) else [("", [], [path])])
+                      for name in files]
+        results = hash_files(file_paths, args.method or ["sha256"], args.workers, args.processes)
+        for file_path, digests in results.items():
+            print(" ".join(digests.values()), file_path)
+    elif args.command == "digest":
+        cache = DigestCache(args.cache)
+        if args.action == "rebuild":
+            for directory in args.dirs:
+                print(f"{cache.rebuild(directory)} files hashed in {directory}")
+        else:
+            mismatched = [f for directory in (args.dirs or [None]) for f in cache.verify(directory)]
+            for file_path in mismatched:
+                print(f"digest mismatch: {file_path}")
+            print(f"{len(cache.entries)} entries ok, {len(mismatched)} mismatched")
+            if mismatched:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+download.py 的asyncio版本：单线程内维持成百上千个在途的区间和文件下载，可以直接嵌入异步服务
+语义与同步版本一致：Range请求、续传日志、Content-Disposition解析文件名、ModelScope按sha256跳过已下载文件
+"""
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+import os.path
+import time
+import traceback
+from typing import Dict, List
+from urllib.parse import quote, urlsplit
+
+import aiohttp
+
+import download
+from download import BlobStore, DigestCache, DownloadMetrics, DownloadProgress, DownloadResult, RangeJournal, RangeScheduler, \
+    RateLimiter, StreamingHasher, TransferTimer, parse_filename
+
+
+def _proxy(url: str, proxies: dict = None) -> str:
+    """requests风格的proxies字典转换为aiohttp的单个proxy"""
+    return (proxies or {}).get(urlsplit(url).scheme)
+
+
+@asynccontextmanager
+async def _session_scope(session: aiohttp.ClientSession = None, max_connections: int = 100):
+    if session is not None:
+        yield session
+        return
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        yield session
+
+
+async def _open_range(session: aiohttp.ClientSession, url: str, start: int, end: int,
+                      proxies: dict = None) -> aiohttp.ClientResponse:
+    # 与同步版本一样按HttpSession.verify校验区间请求的证书
+    response = await session.get(url, headers={'Range': f'bytes={start}-{end - 1}'}, proxy=_proxy(url, proxies),
+                                 ssl=download.HttpSession.verify)
+    try:
+        response.raise_for_status()
+        if response.status != 206:
+            raise IOError(f"server ignored Range header, status = {response.status}")
+        content_range = response.headers.get("Content-Range", "")
+        if not content_range.startswith(f"bytes {start}-{end - 1}/"):
+            raise IOError(f"unexpected Content-Range {content_range}, expect {start}-{end - 1}")
+    except Exception:
+        response.release()
+        raise
+    return response
+
+
+async def _throttle(url: str, size: int) -> float:
+    """与同步worker共享RateLimiter的令牌桶，等待时不阻塞事件循环，返回等待的秒数"""
+    delay = RateLimiter.reserve(url, size)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return delay
+
+
+def _write(fd: int, journal: RangeJournal, hasher: StreamingHasher, data: bytes, offset: int):
+    download._pwrite(fd, data, offset)
+    journal.add(offset, offset + len(data))
+    hasher.update(offset, data)
+
+
+async def download_from_url(base_dir: str, url: str, proxies: dict = None, chunk_size: int = 4*1024*1024,
+                            session: aiohttp.ClientSession = None, progress: DownloadProgress = None,
+                            sha256: str = None) -> str:
+    """从url下载文件到base_dir目录，文件名取自Content-Disposition，给出sha256时校验边下载边计算的摘要"""
+    async with _session_scope(session) as session:
+        request_time = time.monotonic()
+        try:
+            response = await session.get(url, proxy=_proxy(url, proxies), ssl=False)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"下载文件失败：url = {url} {e}")
+            traceback.print_exc()
+            DownloadMetrics.emit("file_failed", url, error=str(e))
+            return None
+        filename = parse_filename(response.headers.get("Content-Disposition", ""))
+        if filename is None:
+            print(f"获取文件名失败：Disposition = {response.headers.get('Content-Disposition')}, url = {url}")
+            response.release()
+            return None
+        result = await _stream_download(session, response, url, os.path.join(base_dir, filename), proxies,
+                                        chunk_size, progress, sha256, request_time)
+        return None if result is None else result.path
+
+
+async def _stream_download(session: aiohttp.ClientSession, response: aiohttp.ClientResponse, url: str,
+                           file_path: str, proxies: dict = None, chunk_size: int = 4*1024*1024,
+                           progress: DownloadProgress = None, sha256: str = None,
+                           request_time: float = None) -> DownloadResult:
+    """
+    把response单流写入file_path并同步计算sha256，存在续传日志时只用Range请求下载缺失的部分，
+    磁盘写入放到线程中避免阻塞事件循环
+    """
+    filename = os.path.basename(file_path)
+    file_size = int(response.headers["Content-Length"])
+    BlobStore.detach(file_path)
+    journal = RangeJournal.load(file_path, file_size, response.headers.get("ETag"))
+    hasher = StreamingHasher(file_path, done_ranges=journal.ranges)
+    resume = len(journal.ranges) > 0
+    if resume:
+        response.release()
+        print(f"resume <{filename}> from {journal.completed_bytes()}/{file_size} bytes")
+    else:
+        journal.reset()
+        try:
+            await asyncio.to_thread(download._preallocate, file_path, file_size)
+        except OSError as e:
+            response.release()
+            print(f"preallocate {filename} failed with {e}")
+            return None
+    fd = os.open(file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    timer = TransferTimer(url, request_time, path=file_path)
+    try:
+        for start, end in journal.missing():
+            stream = await _open_range(session, url, start, end, proxies) if resume else response
+            try:
+                async for chunk in stream.content.iter_chunked(RateLimiter.chunk_size(url, chunk_size)):
+                    timer.chunk(len(chunk), await _throttle(url, len(chunk)))
+                    await asyncio.to_thread(_write, fd, journal, hasher, chunk, start)
+                    start += len(chunk)
+                    if progress is not None:
+                        progress.update(len(chunk))
+            finally:
+                stream.release()
+            if start != end:
+                raise IOError(f"range {start}-{end} incomplete")
+        journal.remove()
+        digest = download._verify(file_path, await asyncio.to_thread(hasher.hexdigest, file_size), sha256)
+        if digest is None:
+            timer.finish("file_failed", error="sha256 mismatch")
+            return None
+        timer.finish("file_done")
+        if progress is None:
+            print("Downloading <{}> file success. file size: {:.2f}GB.".format(file_path, file_size / 1024 ** 3))
+        return DownloadResult(file_path, digest)
+    except Exception as e:
+        journal.flush()
+        print(f"保存文件失败：filename = {filename}, url = {url} {e}")
+        traceback.print_exc()
+        timer.finish("file_failed", error=str(e))
+        return None
+    finally:
+        os.close(fd)
+
+
+async def parallel_download(url: str, local_dir: str, file_name: str, file_size: int = None, proxies: dict = None,
+                            chunk_size: int = 16 * 1024 * 1024, parallels: int = 16,
+                            session: aiohttp.ClientSession = None, budget: asyncio.Semaphore = None,
+                            progress: DownloadProgress = None, sha256: str = None) -> str:
+    """
+    分段并行下载，与同步版本一样预分配目标文件并由RangeScheduler动态分配区间、接管慢区间的尾部，
+    parallels个协程代替线程，budget为多个文件共享的asyncio.Semaphore；成功时返回下载时计算出的sha256
+    """
+    file_path = os.path.join(local_dir, file_name)
+    BlobStore.detach(file_path)
+    journal = RangeJournal.load(file_path, file_size)
+    if journal.ranges and os.path.getsize(file_path) == file_size:
+        print(f"resume {file_name}, {journal.completed_bytes()}/{file_size} bytes already downloaded")
+    else:
+        journal.reset()
+        try:
+            await asyncio.to_thread(download._preallocate, file_path, file_size)
+        except OSError as e:
+            print(f"preallocate {file_name} failed with {e}")
+            return None
+    scheduler = RangeScheduler(journal.missing(), chunk_size, progress=progress)
+    hasher = StreamingHasher(file_path, done_ranges=journal.ranges)
+    budget = budget or nullcontext()
+
+    async def worker():
+        while True:
+            async with budget:
+                if (task := scheduler.next()) is None:
+                    break
+                offset = task.start
+                timer = TransferTimer(url, offset=offset)
+                try:
+                    r = await _open_range(session, url, task.start, task.end, proxies)
+                    try:
+                        async for chunk in r.content.iter_chunked(RateLimiter.chunk_size(url, 1024 * 1024)):
+                            timer.chunk(len(chunk), await _throttle(url, len(chunk)))
+                            size = scheduler.advance(task, len(chunk))
+                            if size > 0:
+                                await asyncio.to_thread(_write, fd, journal, hasher, chunk[:size], offset)
+                                offset += size
+                            if task.start >= task.end:
+                                break
+                    finally:
+                        r.release()
+                    if task.start < task.end:
+                        raise IOError(f"range {offset}-{task.end} incomplete")
+                    scheduler.done(task)
+                    timer.finish("range_done", end=offset)
+                except Exception as e:
+                    print(f"range worker failed with {e}")
+                    scheduler.failed(task, offset)
+                    timer.finish("range_failed", end=offset, error=str(e))
+
+    print(f"starting to download {file_name} with {len(scheduler.pending)} ranges")
+    file_time = time.monotonic()
+    async with _session_scope(session, parallels) as session:
+        fd = os.open(file_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            await asyncio.gather(*(worker() for _ in range(parallels)))
+        finally:
+            os.close(fd)
+    seconds = time.monotonic() - file_time
+    if not scheduler.finished():
+        journal.flush()
+        print(f"download {file_name} failed, {file_size - journal.completed_bytes()} bytes missing")
+        DownloadMetrics.emit("file_failed", url, path=file_path, bytes=scheduler.received, seconds=seconds)
+        return None
+    DownloadMetrics.emit("file_done", url, path=file_path, bytes=scheduler.received, seconds=seconds,
+                         throughput=scheduler.received / seconds if seconds > 0 else 0.0)
+    journal.remove()
+    print(f"finished download {file_name}")
+    return download._verify(file_path, await asyncio.to_thread(hasher.hexdigest, file_size), sha256)
+
+
+async def download_files(tasks: List[tuple], proxies: dict = None, max_connections: int = 64,
+                         large_file_size: int = 64 * 1024 * 1024, session: aiohttp.ClientSession = None,
+                         blob_store: BlobStore = None) -> List[DownloadResult]:
+    """
+    并发下载多个文件，tasks为(url, file_path, file_size, sha256)列表，所有文件和区间共享max_connections个连接，
+    返回与tasks一一对应的结果，失败的为None；给出blob_store时与同步版本一样按sha256去重
+    """
+    budget = asyncio.Semaphore(max_connections)
+    progress = DownloadProgress(len(tasks), sum(task[2] or 0 for task in tasks))
+
+    async def run(session: aiohttp.ClientSession, url: str, file_path: str, file_size: int,
+                  sha256: str) -> DownloadResult:
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        if blob_store is not None and sha256 is not None and \
+                await asyncio.to_thread(blob_store.link, sha256, file_path):
+            progress.file_done(True)
+            return DownloadResult(file_path, sha256)
+        try:
+            if file_size is not None and file_size >= large_file_size:
+                digest = await parallel_download(url, os.path.dirname(file_path), os.path.basename(file_path),
+                                                 file_size, proxies, session=session, budget=budget,
+                                                 progress=progress, sha256=sha256)
+            else:
+                async with budget:
+                    response = await session.get(url, proxy=_proxy(url, proxies), ssl=False)
+                    response.raise_for_status()
+                    result = await _stream_download(session, response, url, file_path, proxies,
+                                                    progress=progress, sha256=sha256)
+                    digest = None if result is None else result.sha256
+        except Exception as e:
+            print(f"下载文件失败：url = {url} {e}")
+            digest = None
+        success = digest is not None
+        if success and blob_store is not None:
+            await asyncio.to_thread(blob_store.add, file_path, digest)
+        if not success:
+            print(f"download {url} to {file_path} failed")
+        progress.file_done(success)
+        return DownloadResult(file_path, digest) if success else None
+
+    async def report():
+        while True:
+            await asyncio.sleep(2)
+            progress.report()
+
+    async with _session_scope(session, max_connections) as session:
+        reporter = asyncio.create_task(report())
+        try:
+            results = await asyncio.gather(*(run(session, *task) for task in tasks))
+        finally:
+            reporter.cancel()
+    progress.report()
+    await asyncio.to_thread(DigestCache.flush_default)
+    return results
+
+
+async def batch_download(base_dir: str, urls: List[str], proxies: dict = None, max_connections: int = 64):
+    print(f'begin downloading {len(urls)} files ...')
+    time_start = time.time()
+    budget = asyncio.Semaphore(max_connections)
+
+    async def run(session: aiohttp.ClientSession, url: str):
+        async with budget:
+            return await download_from_url(base_dir, url, proxies, session=session)
+
+    async with _session_scope(None, max_connections) as session:
+        await asyncio.gather(*(run(session, url) for url in urls))
+    m, s = divmod(time.time() - time_start, 60)
+    h, m = divmod(m, 60)
+    print("file download completed, cost time : {:0>d} h {:0>2d} m {:0>2d} s".format(int(h), int(m), int(s)))
+
+
+async def _get_json(session: aiohttp.ClientSession, url: str, proxies: dict = None):
+    async with session.get(url, proxy=_proxy(url, proxies), ssl=False) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+class HuggingFace:
+
+    """
+    download.HuggingFace 的asyncio版本，endpoint与之共用
+    """
+
+    @classmethod
+    async def get_file_metas(cls, session: aiohttp.ClientSession, repo_id: str, revision: str = "main",
+                             proxies: Dict = None) -> List[dict]:
+        url = f"{download.HuggingFace.endpoint}/api/models/{repo_id}/revision/{quote(revision,safe='')}?blobs=true"
+        try:
+            resp_json = await _get_json(session, url, proxies)
+            return [{"path": _["rfilename"], "size": _.get("size"), "sha256": (_.get("lfs") or {}).get("sha256")}
+                    for _ in resp_json["siblings"]]
+        except Exception as e:
+            print(f"获取文件列表失败：url = {url} {e}")
+            traceback.print_exc()
+            return []
+
+    @classmethod
+    async def download_model(cls, repo_id: str, base_dir: str, proxies: dict = None, revision: str = "main",
+                             max_connections: int = 64, blob_store: BlobStore = None):
+        endpoint = download.HuggingFace.endpoint
+        base_dir = os.path.join(base_dir, repo_id)
+        os.makedirs(base_dir, exist_ok=True)
+        print(f"begin download model {repo_id} revision {revision} from Hugging Face!")
+        time_start = time.time()
+        async with _session_scope(None, max_connections) as session:
+            files = await cls.get_file_metas(session, repo_id, revision, proxies)
+            tasks = [(f"{endpoint}/{repo_id}/resolve/{quote(revision,safe='')}/{quote(file['path'])}",
+                      os.path.join(base_dir, file["path"]), file["size"], file["sha256"]) for file in files]
+            results = await download_files(tasks, proxies, max_connections, session=session, blob_store=blob_store)
+            success_cnt = sum(result is not None for result in results)
+        m, s = divmod(time.time() - time_start, 60)
+        h, m = divmod(m, 60)
+        print(
+            f"{success_cnt}/{len(files)} file download completed, cost time: {int(h):0>d}h {int(m):0>2d}m {int(s):0>2d}s"
+        )
+        print(f"success download model {repo_id} revision {revision} from Hugging Face!")
+
+
+class ModelScope:
+
+    """
+    download.ModelScope 的asyncio版本，base_url与之共用，同样校验sha避免重复下载
+    """
+
+    @classmethod
+    async def get_revisions(cls, session: aiohttp.ClientSession, model_name: str, proxies: dict = None) -> List[str]:
+        url = f"{download.ModelScope.base_url}/{model_name}/revisions"
+        try:
+            resp_json = await _get_json(session, url, proxies)
+            return [revision["Revision"] for revision in resp_json["Data"]["RevisionMap"]["Branches"]]
+        except Exception as e:
+            print(f"获取版本列表失败：url = {url} {e}")
+            traceback.print_exc()
+            return []
+
+    @classmethod
+    async def get_files(cls, session: aiohttp.ClientSession, model_name: str, revision: str,
+                        proxies: dict = None) -> List[dict]:
+        url = f"{download.ModelScope.base_url}/{model_name}/repo/files?Revision={revision}&Root="
+        try:
+            resp_json = await _get_json(session, url, proxies)
+            return [{"path": _["Path"], "sha256": _["Sha256"], "size": _.get("Size")} for _ in resp_json["Data"]["Files"]]
+        except Exception as e:
+            print(f"获取文件列表失败：url = {url} {e}")
+            traceback.print_exc()
+            return []
+
+    @classmethod
+    async def download_model(cls, repo_id: str, base_dir: str, proxies: dict = None, max_connections: int = 64,
+                             blob_store: BlobStore = None):
+        base_url = download.ModelScope.base_url
+        base_dir = os.path.join(base_dir, repo_id)
+        os.makedirs(base_dir, exist_ok=True)
+        print(f"begin download model {repo_id} from model scope!")
+        async with _session_scope(None, max_connections) as session:
+            revisions = await cls.get_revisions(session, repo_id, proxies)
+            if len(revisions) == 0:
+                print(f"没有找到版本列表：model_name = {repo_id}")
+                return
+            revision = revisions[0]
+            print(f"使用版本：{revision}")
+            files = await cls.get_files(session, repo_id, revision, proxies)
+            if len(files) == 0:
+                print(f"没有文件列表：model_name = {repo_id}, revision = {revision}")
+                return
+            time_start = time.time()
+            success_cnt = 0
+            tasks = []
+            for file in files:
+                local_file_path = os.path.join(base_dir, file["path"])
+                if os.path.exists(local_file_path) and \
+                        await asyncio.to_thread(DigestCache.default().file_hash, local_file_path) == file["sha256"]:
+                    success_cnt += 1
+                    continue
+                url = f"{base_url}/{repo_id}/repo?Revision={revision}&FilePath={file['path']}"
+                tasks.append((url, local_file_path, file["size"], file["sha256"]))
+            results = await download_files(tasks, proxies, max_connections, session=session, blob_store=blob_store)
+            success_cnt += sum(result is not None for result in results)
+        m, s = divmod(time.time() - time_start, 60)
+        h, m = divmod(m, 60)
+        print(
+            f"{success_cnt}/{len(files)} file download completed, cost time: {int(h):0>d}h {int(m):0>2d}m {int(s):0>2d}s"
+        )
+        print(f"success download model {repo_id} from model scope!")
@@ -0,0 +1,255 @@
+"""
+download.py 的基准测试：在本地启动支持Range和Content-Disposition的HTTP替身服务器，可以注入单连接带宽上限、延迟和失败，
+对download_from_url、parallel_download和file_hash按文件大小、块大小、并发数组合运行，报告MB/s、峰值RSS和CPU时间，
+结果追加到jsonl文件中，并与之前版本的同一组合比较，找出性能回退；同时报告import download的耗时
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import os.path
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BLOCK = random.Random(0).randbytes(1024 * 1024)
+
+
+def synthetic_bytes(start: int, end: int) -> bytes:
+    """文件内容由固定的1M随机块循环而成，任意区间都可以直接算出来，不需要真的存一个大文件"""
+    offset = start % len(BLOCK)
+    data = BLOCK[offset:] + BLOCK * ((end - start) // len(BLOCK) + 1)
+    return data[:end - start]
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+
+    """/files/<size> 返回size字节的合成文件，服务器参数挂在self.server上"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        match = re.fullmatch(r"/files/(\d+)", self.path.split("?")[0])
+        if match is None:
+            self.send_error(404)
+            return
+        size = int(match.group(1))
+        time.sleep(self.server.latency)
+        start, end = 0, size
+        range_header = self.headers.get("Range")
+        if range_header:
+            range_match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header)
+            start = int(range_match.group(1))
+            end = min(size, int(range_match.group(2)) + 1) if range_match.group(2) else size
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Disposition", f"attachment;filename=bench_{size}.bin")
+        self.end_headers()
+        step = 256 * 1024
+        sent, begin = 0, time.monotonic()
+        for offset in range(start, end, step):
+            if random.random() < self.server.failure_rate:
+                self.close_connection = True
+                return
+            chunk = synthetic_bytes(offset, min(offset + step, end))
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            sent += len(chunk)
+            if self.server.bandwidth:
+                delay = sent / self.server.bandwidth - (time.monotonic() - begin)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class BenchServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, bandwidth: float = None, latency: float = 0.0, failure_rate: float = 0.0):
+        """bandwidth为单连接带宽上限(bytes/s)，latency为每个请求的响应延迟(s)，failure_rate为每发送256K中途断开连接的概率"""
+        super().__init__(("127.0.0.1", 0), BenchHandler)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def handle_error(self, request, client_address):
+        # 被接管或中途放弃的区间由客户端断开连接，属于正常情况，不打印堆栈以免淹没结果表
+        if issubclass(sys.exc_info()[0], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def url(self, size: int) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/files/{size}"
+
+    def start(self) -> "BenchServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def run_case(case: dict) -> dict:
+    """在独立的子进程中运行一个组合，这样峰值RSS和CPU时间只属于这个组合"""
+    import download
+    download.HttpSession.configure(retries=10, backoff_factor=0.01)
+    download.DigestCache.record_downloads = False
+    work_dir = tempfile.mkdtemp(prefix="download_bench_")
+    size = case["size"]
+    try:
+        if case["path"] == "file_hash":
+            file_path = os.path.join(work_dir, "hash.bin")
+            with open(file_path, "wb") as f:
+                for offset in range(0, size, len(BLOCK)):
+                    f.write(synthetic_bytes(offset, min(offset + len(BLOCK), size)))
+        cpu_start, time_start = os.times(), time.perf_counter()
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                if case["path"] == "download_from_url":
+                    success = download.download_from_url(work_dir, case["url"], chunk_size=case["chunk_size"]) is not None
+                elif case["path"] == "parallel_download":
+                    success = download.parallel_download(case["url"], work_dir, "bench.bin", size,
+                                                         chunk_size=case["chunk_size"], parallels=case["workers"],
+                                                         max_parallels=case["workers"]) is not None
+                else:
+                    success = download.file_hashes(file_path, buffer_size=case["chunk_size"]) is not None
+            finally:
+                sys.stdout = stdout
+        seconds = time.perf_counter() - time_start
+        cpu_end = os.times()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "success": success,
+        "seconds": seconds,
+        "mb_per_s": size / 1024 / 1024 / seconds,
+        "cpu_seconds": (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system),
+        "peak_rss_mb": None if peak_rss is None else peak_rss / 1024 / 1024,
+    }
+
+
+def import_time(module: str = "download", repeat: int = 5) -> float:
+    """在新的解释器中导入module，返回多次测量中最短的累计导入时间(ms)"""
+    times = []
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+        for line in stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1000)
+    return min(times)
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def case_key(case: dict) -> str:
+    key = "{path} size={size} chunk={chunk_size} workers={workers}".format(**case)
+    if case["path"] != "file_hash" and (case["bandwidth"] or case["latency"] or case["failure_rate"]):
+        key += " bw={bandwidth} lat={latency} fail={failure_rate}".format(**case)
+    return key
+
+
+def previous_results(output: str, version: str) -> dict:
+    """读取其他版本最近一次的结果，{case_key: result}"""
+    results = {}
+    if not os.path.isfile(output):
+        return results
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["version"] != version and record["success"]:
+                results[record["key"]] = record
+    return results
+
+
+def parse_size(text: str) -> int:
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    return int(float(text[:-1]) * units[text[-1]]) if text[-1] in units else int(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark download.py against a local HTTP stand-in server")
+    parser.add_argument("--paths", default="download_from_url,parallel_download,file_hash")
+    parser.add_argument("--sizes", default="16M,256M")
+    parser.add_argument("--chunk-sizes", default="1M,16M")
+    parser.add_argument("--workers", default="1,4,8", help="worker counts for parallel_download")
+    parser.add_argument("--bandwidth", default=None, help="per-connection bandwidth cap, e.g. 20M (bytes/s)")
+    parser.add_argument("--latency", type=float, default=0.0, help="response latency in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability to drop a connection per 256K")
+    parser.add_argument("--output", default="download_bench_results.jsonl")
+    parser.add_argument("--regression", type=float, default=0.1, help="report cases slower than previous by this ratio")
+    parser.add_argument("--import-budget", type=float, default=50, help="warn when import download takes longer (ms)")
+    args = parser.parse_args()
+
+    import_ms = import_time()
+    print(f"import download: {import_ms:.1f}ms (budget {args.import_budget:.0f}ms)")
+    if import_ms > args.import_budget:
+        # 导入时间受机器负载影响，只提示不中断；是否引入了重量级依赖由test_import_time.py检查
+        print(f"WARNING import download takes {import_ms:.1f}ms, over the {args.import_budget:.0f}ms budget")
+
+    server = BenchServer(parse_size(args.bandwidth) if args.bandwidth else None, args.latency,
+                         args.failure_rate).start()
+    version = git_version()
+    previous = previous_results(args.output, version)
+    cases = []
+    for path, size, chunk_size in itertools.product(args.paths.split(","), args.sizes.split(","),
+                                                    args.chunk_sizes.split(",")):
+        for workers in ([int(w) for w in args.workers.split(",")] if path == "parallel_download" else [1]):
+            cases.append({"path": path, "size": parse_size(size), "chunk_size": parse_size(chunk_size),
+                          "workers": workers, "url": server.url(parse_size(size)), "bandwidth": args.bandwidth,
+                          "latency": args.latency, "failure_rate": args.failure_rate})
+    regressions = []
+    print(f"version {version}, {len(cases)} cases")
+    print(f"{'case':<70} {'MB/s':>9} {'cpu s':>7} {'rss MB':>8}")
+    with open(args.output, "a", encoding="utf-8") as output:
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_case, case).result()
+            key = case_key(case)
+            record = {"version": version, "time": time.time(), "key": key,
+                      **{k: v for k, v in case.items() if k != "url"}, **result}
+            output.write(json.dumps(record) + "\n")
+            rss = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.1f}"
+            status = "" if result["success"] else "  FAILED"
+            print(f"{key:<70} {result['mb_per_s']:>9.2f} {result['cpu_seconds']:>7.2f} {rss:>8}{status}")
+            before = previous.get(key)
+            if before and result["mb_per_s"] < before["mb_per_s"] * (1 - args.regression):
+                regressions.append((key, before, result))
+    server.shutdown()
+    for key, before, result in regressions:
+        print(f"REGRESSION {key}: {before['mb_per_s']:.2f} MB/s ({before['version']}) -> {result['mb_per_s']:.2f} MB/s")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+download.py 的本地缓存代理模式：对外提供与Hugging Face（/<repo>/resolve/<revision>/<path>）和
+ModelScope（/api/v1/models/<repo>/repo?Revision=&FilePath=）相同的url，把HuggingFace.endpoint或ModelScope.base_url指向代理即可使用
+文件缓存在本地磁盘上，Range请求直接从缓存读取；多个客户端同时请求同一文件时只回源一次，回源过程中按已完成的区间边下边发
+其他请求（文件列表、版本列表等接口）直接转发给上游，不缓存
+"""
+import hashlib
+import json
+import os.path
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import urlsplit
+
+import download
+from download import BufferPool, HuggingFace, ModelScope, RangeJournal, http_get
+
+KEEP_HEADERS = ("Content-Disposition", "Content-Type", "ETag", "Last-Modified", "X-Repo-Commit")
+
+
+class _Fill:
+
+    """
+    代理中的一个文件：缓存有效时直接读缓存，否则在后台线程中用parallel_download回源，
+    请求同一文件的所有客户端共享这次回源，通过RangeJournal等待各自需要的区间
+    """
+
+    def __init__(self, proxy: "CachingProxy", url: str):
+        self.proxy = proxy
+        self.url = url
+        self.key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        self.meta_path = os.path.join(proxy.cache_dir, self.key + ".json")
+        self.meta = None
+        self.journal = None
+        self.error = None
+        self.done = False
+        self.ready = threading.Event()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.proxy.cache_dir, self.meta["file"])
+
+    def _load_meta(self) -> dict:
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            return meta if os.path.isfile(os.path.join(self.proxy.cache_dir, meta["file"])) else None
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _finish(self, meta: dict = None, error: tuple = None):
+        self.meta, self.error, self.done = meta or self.meta, error, error is None
+        self.ready.set()
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as e:
+            print(f"proxy fill {self.url} failed with {e}")
+            self._finish(error=(502, str(e)))
+        finally:
+            if self.journal is not None:
+                with self.journal.changed:
+                    self.journal.changed.notify_all()
+            self.proxy.release(self)
+
+    def _run(self):
+        cached = self._load_meta()
+        if cached is not None and cached["complete"] and time.time() - cached["checked"] < self.proxy.ttl:
+            self._finish(cached)
+            return
+        try:
+            # 只请求第一个字节，从Content-Range中取文件大小，空文件会返回416
+            response = http_get(self.url, headers={"Range": "bytes=0-0"}, stream=True, proxies=self.proxy.proxies,
+                                verify=False)
+            response.close()
+        except Exception as e:
+            if cached is not None and cached["complete"]:
+                print(f"upstream {self.url} unreachable ({e}), serve cached copy")
+                self._finish(cached)
+                return
+            raise
+        total = re.fullmatch(r"bytes (?:\d+-\d+|\*)/(\d+)", response.headers.get("Content-Range", ""))
+        if response.status_code in (206, 416) and total:
+            size = int(total.group(1))
+        elif response.status_code == 200 and "Content-Length" in response.headers:
+            size = int(response.headers["Content-Length"])
+        elif response.status_code >= 400:
+            self._finish(error=(response.status_code, response.reason))
+            return
+        else:
+            self._finish(error=(502, "upstream response has no file size"))
+            return
+        etag = response.headers.get("ETag")
+        if cached is not None and cached["complete"] and cached["size"] == size and cached["etag"] == etag:
+            cached["checked"] = time.time()
+            self.meta = cached
+            self._save_meta()
+            self._finish(cached)
+            return
+        # 内容变化时写入新文件，正在读旧文件的客户端不受影响
+        file_name = f"{self.key}-{hashlib.sha256((etag or '').encode('utf-8')).hexdigest()[:16]}"
+        self.meta = {"url": self.url, "file": file_name, "size": size, "etag": etag, "checked": time.time(),
+                     "complete": False, "headers": {k: response.headers[k] for k in KEEP_HEADERS
+                                                    if k in response.headers}}
+        self.journal = RangeJournal.load(os.path.join(self.proxy.cache_dir, file_name), size, etag)
+        self.ready.set()
+        # 跟随重定向后的地址回源，避免每个区间都再重定向一次
+        digest = download.parallel_download(response.url, self.proxy.cache_dir, file_name, size, self.proxy.proxies,
+                                            parallels=self.proxy.parallels, journal=self.journal)
+        if digest is None:
+            self._finish(error=(502, "upstream download failed"))
+            return
+        self.meta["complete"] = True
+        self._save_meta()
+        if cached is not None and cached["file"] != file_name:
+            os.remove(os.path.join(self.proxy.cache_dir, cached["file"]))
+        self._finish()
+
+    def wait(self, pos: int) -> int:
+        """等待pos处的数据写入缓存，返回从pos起可以读取的终点"""
+        while not self.done:
+            end = self.journal.wait(pos, timeout=1)
+            if end > pos:
+                return end
+            if self.error is not None:
+                raise IOError(self.error[1])
+        return self.meta["size"]
+
+
+class CachingProxy(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, cache_dir: str, host: str = "127.0.0.1", port: int = 8090, proxies: dict = None,
+                 ttl: float = 600, parallels: int = 4):
+        """
+        cache_dir为缓存目录，proxies为回源使用的代理；缓存超过ttl秒后用上游的ETag和大小重新校验，上游不可达时继续使用缓存
+        上游地址取自HuggingFace.endpoint和ModelScope.base_url
+        """
+        super().__init__((host, port), ProxyHandler)
+        self.cache_dir = cache_dir
+        self.proxies = proxies
+        self.ttl = ttl
+        self.parallels = parallels
+        self.fills: Dict[str, _Fill] = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def upstream_url(path: str) -> str:
+        if path.startswith("/api/v1/"):
+            parsed = urlsplit(ModelScope.base_url)
+            return f"{parsed.scheme}://{parsed.netloc}{path}"
+        return HuggingFace.endpoint + path
+
+    @staticmethod
+    def is_file(path: str) -> bool:
+        parsed = urlsplit(path)
+        if parsed.path.startswith("/api/"):
+            return re.fullmatch(r"/api/v1/models/.+/repo", parsed.path) is not None and "FilePath=" in parsed.query
+        return "/resolve/" in parsed.path
+
+    def open(self, url: str) -> _Fill:
+        """返回url对应的_Fill，同一文件正在回源时复用"""
+        with self.lock:
+            fill = self.fills.get(url)
+            if fill is None:
+                fill = self.fills[url] = _Fill(self, url)
+                threading.Thread(target=fill.run, daemon=True).start()
+        fill.ready.wait()
+        return fill
+
+    def release(self, fill: _Fill):
+        with self.lock:
+            if self.fills.get(fill.url) is fill:
+                del self.fills[fill.url]
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle(True)
+
+    def do_HEAD(self):
+        self._handle(False)
+
+    def _handle(self, send_body: bool):
+        url = self.server.upstream_url(self.path)
+        try:
+            if self.server.is_file(self.path):
+                self._send_file(self.server.open(url), send_body)
+            else:
+                self._pass_through(url, send_body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send_file(self, fill: _Fill, send_body: bool):
+        if fill.error is not None:
+            self.send_error(*fill.error)
+            return
+        size = fill.meta["size"]
+        start, end = 0, size
+        range_match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", "").strip())
+        if range_match and range_match.group(1):
+            start = int(range_match.group(1))
+            end = min(size, int(range_match.group(2)) + 1) if range_match.group(2) else size
+        elif range_match and range_match.group(2):
+            start = max(0, size - int(range_match.group(2)))
+        if range_match and start >= end:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if range_match else 200)
+        if range_match:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        for key, value in fill.meta["headers"].items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not send_body:
+            return
+        try:
+            if start == end:
+                return
+            # 回源刚开始时缓存文件可能还没创建，等到第一段数据写入后再打开
+            pos, available = start, min(fill.wait(start), end)
+            # 不从BufferPool借缓冲区：客户端会阻塞在回源前沿或慢速的wfile.write上，占满有上限的池后回源的range_worker
+            # 再也借不到缓冲区，回源和所有等待它的客户端一起卡死
+            buffer = memoryview(bytearray(min(BufferPool.buffer_size, end - start)))
+            with open(fill.path, "rb") as f:
+                while pos < end:
+                    if pos == available:
+                        available = min(fill.wait(pos), end)
+                    f.seek(pos)
+                    while pos < available:
+                        size = f.readinto(buffer[:min(len(buffer), available - pos)])
+                        self.wfile.write(buffer[:size])
+                        pos += size
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except IOError as e:
+            # 响应头已经发出，只能断开连接让客户端重试
+            print(f"proxy send {fill.url} failed with {e}")
+            self.close_connection = True
+
+    def _pass_through(self, url: str, send_body: bool):
+        headers = {k: self.headers[k] for k in ("If-None-Match", "Accept") if k in self.headers}
+        try:
+            response = http_get(url, headers=headers, proxies=self.server.proxies, verify=False)
+        except Exception as e:
+            self.send_error(502, str(e))
+            return
+        self.send_response(response.status_code)
+        for key in ("Content-Type", "ETag"):
+            if key in response.headers:
+                self.send_header(key, response.headers[key])
+        self.send_header("Content-Length", str(len(response.content)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(response.content)
+
+
+def serve(cache_dir: str, host: str = "127.0.0.1", port: int = 8090, proxies: dict = None, ttl: float = 600,
+          parallels: int = 4):
+    # 缓存文件只由代理自己按ETag管理，不记入全局摘要缓存
+    download.DigestCache.record_downloads = False
+    proxy = CachingProxy(cache_dir, host, port, proxies, ttl, parallels)
+    print(f"caching proxy listening on http://{host}:{proxy.server_address[1]}, cache dir {cache_dir}")
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.server_close()
@@ -0,0 +1,71 @@
+"""
+life_engine.py 的基准测试：对每个引擎和棋盘大小的组合，在独立的子进程中用随机汤演化若干代，
+报告每秒更新的细胞数、引擎状态占用的内存和峰值RSS，结果追加到jsonl文件中
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def run_case(case: dict) -> dict:
+    import life_engine
+    cells = life_engine.random_cells(case["size"], case["size"], case["density"], seed=0)
+    # 只在构建棋盘时跟踪内存分配，tracemalloc会让演化本身慢很多
+    tracemalloc.start()
+    engine = life_engine.new_engine(case["engine"], case["size"], case["size"], cells)
+    del cells
+    state_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for _ in range(case["warmup"]):
+        engine.step()
+    start = time.perf_counter()
+    for _ in range(case["generations"]):
+        engine.step()
+    seconds = time.perf_counter() - start
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "seconds": seconds,
+        "cell_updates_per_s": case["size"] ** 2 * case["generations"] / seconds,
+        "state_mb": state_bytes / 1024 / 1024,
+        "peak_rss_mb": None if peak_rss is None else peak_rss / 1024 / 1024,
+        "population": engine.population,
+    }
+
+
+def main():
+    import life_engine
+    parser = argparse.ArgumentParser(description="benchmark the Game of Life engines on random soups")
+    parser.add_argument("--engines", default=",".join(life_engine.ENGINES))
+    parser.add_argument("--sizes", default="128,512,1024", help="board side lengths")
+    parser.add_argument("--generations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--density", type=float, default=0.3)
+    parser.add_argument("--output", default="life_bench_results.jsonl")
+    args = parser.parse_args()
+
+    print(f"{'engine':<10} {'size':>11} {'Mcells/s':>10} {'state MB':>9} {'rss MB':>8}")
+    with open(args.output, "a", encoding="utf-8") as output:
+        for engine, size in itertools.product(args.engines.split(","), args.sizes.split(",")):
+            case = {"engine": engine, "size": int(size), "generations": args.generations, "warmup": args.warmup,
+                    "density": args.density}
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_case, case).result()
+            output.write(json.dumps({"time": time.time(), **case, **result}) + "\n")
+            rss = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.1f}"
+            print(f"{engine:<10} {f'{size}x{size}':>11} {result['cell_updates_per_s'] / 1e6:>10.2f} "
+                  f"{result['state_mb']:>9.2f} {rss:>8}")
+
+
+if __name__ == "__main__":
+    main()
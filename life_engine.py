@@ -0,0 +1,595 @@
+"""
+生命游戏的演化引擎，不依赖PyQt，可以在life_game.py的界面中使用，也可以无界面批量运行：
+python life_engine.py batch --count 100 --generations 1000 --engine numpy
+所有引擎的接口相同：add/discard/__contains__编辑细胞，cells(region)列出活细胞，step()前进一步，population和generation
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os.path
+import re
+import time
+
+import numpy as np
+
+
+class SparseEngine:
+    """
+    活细胞保存为(行, 列)的集合，在无限平面上演化
+    邻域没有变化的细胞下一代也不会变化，所以每代只检查上一代出生或死亡的细胞及其邻居，
+    代价与变化的细胞数成正比，图案稳定成静物和振荡器后几乎不再有计算量
+    """
+
+    def __init__(self, height: int, width: int):
+        self.height = height
+        self.width = width
+        self.lives = set()
+        self.changed = set()
+        self.generation = 0
+
+    def __contains__(self, cell) -> bool:
+        return cell in self.lives
+
+    def add(self, cell):
+        self.lives.add(cell)
+        self.changed.add(cell)
+
+    def discard(self, cell):
+        self.lives.discard(cell)
+        self.changed.add(cell)
+
+    def cells(self, region=None):
+        """活细胞(行, 列)，region=(top, left, bottom, right)时只返回该区域内的细胞"""
+        if region is None:
+            return iter(self.lives)
+        top, left, bottom, right = region
+        return ((x, y) for x, y in self.lives if top <= x < bottom and left <= y < right)
+
+    @property
+    def population(self) -> int:
+        return len(self.lives)
+
+    def step(self):
+        # 变化的细胞很多时逐个检查邻域反而更慢，按活细胞统计邻居数
+        if len(self.changed) * 3 > len(self.lives):
+            self._step_all()
+        else:
+            self._step_changed()
+        self.generation += 1
+
+    def _step_all(self):
+        neighbor_cnt = {}
+        for x, y in self.lives:
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    if dx == 0 and dy == 0:
+                        continue
+                    neighbor_cnt[(x + dx, y + dy)] = neighbor_cnt.get((x + dx, y + dy), 0) + 1
+        new_lives = set()
+        for key, cnt in neighbor_cnt.items():
+            if cnt == 3:
+                new_lives.add(key)
+            elif cnt == 2 and key in self.lives:
+                new_lives.add(key)
+        self.changed = new_lives ^ self.lives
+        self.lives = new_lives
+
+    def _step_changed(self):
+        lives = self.lives
+        candidates = {(x + dx, y + dy) for x, y in self.changed for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+        born, died = [], []
+        for x, y in candidates:
+            cnt = 0
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    if (dx or dy) and (x + dx, y + dy) in lives:
+                        cnt += 1
+            if (x, y) in lives:
+                if cnt != 2 and cnt != 3:
+                    died.append((x, y))
+            elif cnt == 3:
+                born.append((x, y))
+        lives.difference_update(died)
+        lives.update(born)
+        self.changed = set(born)
+        self.changed.update(died)
+
+
+class NumpyEngine:
+    """
+    活细胞保存为height*width的uint8数组，每代用错位切片把3x3邻域加起来，全部在numpy中向量化完成
+    邻域和t包含细胞自身：t == 3时下一代存活，t == 4时保持原状态；先按行求三格和再按列求三格和，只需4次加法
+    棋盘划分为tile*tile的块，active记录上一代有变化的块，只计算这些块及其相邻的块，其余稳定的块直接跳过；
+    大部分块都在变化时对整个棋盘一次计算；wrap=True时上下、左右边界相连，否则棋盘外的细胞视为死亡
+    """
+
+    def __init__(self, height: int, width: int, wrap: bool = False, tile: int = 32):
+        self.height = height
+        self.width = width
+        self.wrap = wrap
+        self.tile = tile
+        self.board = np.zeros((height, width), dtype=np.uint8)
+        self.active = np.ones((-(-height // tile), -(-width // tile)), dtype=bool)
+        self.generation = 0
+        self._padded = np.zeros((height + 2, width + 2), dtype=np.uint8)
+        self._rows = np.empty((height + 2, width), dtype=np.uint8)
+        self._total = np.empty((height, width), dtype=np.uint8)
+
+    def _inside(self, cell) -> bool:
+        return 0 <= cell[0] < self.height and 0 <= cell[1] < self.width
+
+    def __contains__(self, cell) -> bool:
+        return self._inside(cell) and bool(self.board[cell])
+
+    def add(self, cell):
+        if self._inside(cell):
+            self.board[cell] = 1
+            self.active[cell[0] // self.tile, cell[1] // self.tile] = True
+
+    def discard(self, cell):
+        if self._inside(cell):
+            self.board[cell] = 0
+            self.active[cell[0] // self.tile, cell[1] // self.tile] = True
+
+    def cells(self, region=None):
+        top, left, bottom, right = region or (0, 0, self.height, self.width)
+        top, left = max(top, 0), max(left, 0)
+        rows, cols = np.nonzero(self.board[top:bottom, left:right])
+        return zip((rows + top).tolist(), (cols + left).tolist())
+
+    @property
+    def population(self) -> int:
+        return int(np.count_nonzero(self.board))
+
+    @staticmethod
+    def _rule(window: np.ndarray, old: np.ndarray) -> np.ndarray:
+        """window为old外加一圈邻居，返回old的下一代"""
+        rows = window[:, :-2] + window[:, 1:-1] + window[:, 2:]
+        total = rows[:-2] + rows[1:-1] + rows[2:]
+        return ((total == 3) | ((total == 4) & (old == 1))).view(np.uint8)
+
+    def _tile_any(self, diff: np.ndarray, top: int = 0, left: int = 0) -> np.ndarray:
+        """diff为从(top, left)开始、按块对齐的区域，返回其中每个块是否有变化"""
+        tile = self.tile
+        diff = np.logical_or.reduceat(diff, np.arange(0, diff.shape[0], tile), axis=0)
+        return np.logical_or.reduceat(diff, np.arange(0, diff.shape[1], tile), axis=1)
+
+    def step(self):
+        padded, rows, total, board, tile = self._padded, self._rows, self._total, self.board, self.tile
+        padded[1:-1, 1:-1] = board
+        if self.wrap:
+            padded[0, 1:-1], padded[-1, 1:-1] = board[-1], board[0]
+            padded[:, 0], padded[:, -1] = padded[:, -2], padded[:, 1]
+        # 有变化的块和与它相邻的块下一代才可能变化
+        flags = np.pad(self.active, 1, mode="wrap" if self.wrap else "constant")
+        work = np.zeros_like(self.active)
+        for dr in range(3):
+            for dc in range(3):
+                work |= flags[dr:dr + work.shape[0], dc:dc + work.shape[1]]
+        if work.mean() > 0.5:
+            np.add(padded[:, :-2], padded[:, 1:-1], out=rows)
+            np.add(rows, padded[:, 2:], out=rows)
+            np.add(rows[:-2], rows[1:-1], out=total)
+            np.add(total, rows[2:], out=total)
+            self.board = ((total == 3) | ((total == 4) & (board == 1))).view(np.uint8)
+            self.active = self._tile_any(self.board != board)
+        else:
+            active = np.zeros_like(work)
+            for tile_row in np.flatnonzero(work.any(axis=1)).tolist():
+                cols = np.flatnonzero(work[tile_row])
+                # 同一行中连续的块合并成一个切片计算
+                for run in np.split(cols, np.flatnonzero(np.diff(cols) > 1) + 1):
+                    top, bottom = tile_row * tile, min((tile_row + 1) * tile, self.height)
+                    left, right = int(run[0]) * tile, min((int(run[-1]) + 1) * tile, self.width)
+                    old = board[top:bottom, left:right]
+                    new = self._rule(padded[top:bottom + 2, left:right + 2], old)
+                    active[tile_row, run] = self._tile_any(new != old)[0]
+                    old[...] = new
+            self.active = active
+        self.generation += 1
+
+
+class _Node:
+    """HashLife四叉树节点，相同内容的节点只有一个实例，所以可以直接用对象本身作为字典的键"""
+
+    __slots__ = ("nw", "ne", "sw", "se", "level", "population")
+
+    def __init__(self, nw, ne, sw, se, level: int, population: int):
+        self.nw, self.ne, self.sw, self.se = nw, ne, sw, se
+        self.level = level
+        self.population = population
+
+
+class HashLifeEngine:
+    """
+    HashLife：棋盘是边长2^level的四叉树，内容相同的子树共享同一个节点（hash consing），
+    每个节点中心区域在2^j代之后的状态记忆在_results中，重复出现的结构只计算一次，规则的图案可以一次跳过成千上万代
+    每次step前进2^step_log2代，在无限平面上演化；节点表超过max_nodes时丢弃记忆结果，只保留当前图案用到的节点
+    """
+
+    def __init__(self, height: int = 0, width: int = 0, step_log2: int = 0, max_nodes: int = 1 << 21):
+        self.height = height
+        self.width = width
+        self.step_log2 = step_log2
+        self.max_nodes = max_nodes
+        self.generation = 0
+        self._nodes = {}
+        self._results = {}
+        self._empty = []
+        self._off = _Node(None, None, None, None, 0, 0)
+        self._on = _Node(None, None, None, None, 0, 1)
+        self.root = self._empty_node(3)
+
+    def _join(self, nw: _Node, ne: _Node, sw: _Node, se: _Node) -> _Node:
+        key = (nw, ne, sw, se)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = _Node(nw, ne, sw, se, nw.level + 1,
+                                            nw.population + ne.population + sw.population + se.population)
+        return node
+
+    def _empty_node(self, level: int) -> _Node:
+        while len(self._empty) <= level:
+            self._empty.append(self._off if not self._empty else
+                               self._join(*[self._empty[-1]] * 4))
+        return self._empty[level]
+
+    def _expand(self, node: _Node) -> _Node:
+        """外面加一圈空白，边长加倍，原节点仍在中心"""
+        e = self._empty_node(node.level - 1)
+        return self._join(self._join(e, e, e, node.nw), self._join(e, e, node.ne, e),
+                          self._join(e, node.sw, e, e), self._join(node.se, e, e, e))
+
+    def _contains(self, row: int, col: int) -> bool:
+        half = 1 << (self.root.level - 1)
+        return -half <= row < half and -half <= col < half
+
+    def _set(self, node: _Node, row: int, col: int, alive: bool) -> _Node:
+        if node.level == 0:
+            return self._on if alive else self._off
+        half = 1 << (node.level - 1)
+        nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+        if row < half:
+            if col < half:
+                nw = self._set(nw, row, col, alive)
+            else:
+                ne = self._set(ne, row, col - half, alive)
+        elif col < half:
+            sw = self._set(sw, row - half, col, alive)
+        else:
+            se = self._set(se, row - half, col - half, alive)
+        return self._join(nw, ne, sw, se)
+
+    def __contains__(self, cell) -> bool:
+        row, col = cell
+        if not self._contains(row, col):
+            return False
+        node, half = self.root, 1 << (self.root.level - 1)
+        row, col = row + half, col + half
+        while node.level > 0:
+            half = 1 << (node.level - 1)
+            if row < half:
+                node = node.nw if col < half else node.ne
+            else:
+                node = node.sw if col < half else node.se
+            row, col = row % half, col % half
+        return node is self._on
+
+    def add(self, cell):
+        while not self._contains(*cell):
+            self.root = self._expand(self.root)
+        half = 1 << (self.root.level - 1)
+        self.root = self._set(self.root, cell[0] + half, cell[1] + half, True)
+
+    def discard(self, cell):
+        if self._contains(*cell):
+            half = 1 << (self.root.level - 1)
+            self.root = self._set(self.root, cell[0] + half, cell[1] + half, False)
+
+    def cells(self, region=None):
+        half = 1 << (self.root.level - 1)
+        stack = [(self.root, -half, -half)]
+        while stack:
+            node, top, left = stack.pop()
+            size = 1 << node.level
+            if node.population == 0 or region is not None and (
+                    top >= region[2] or left >= region[3] or top + size <= region[0] or left + size <= region[1]):
+                continue
+            if node.level == 0:
+                yield top, left
+                continue
+            half = size >> 1
+            stack += [(node.nw, top, left), (node.ne, top, left + half),
+                      (node.sw, top + half, left), (node.se, top + half, left + half)]
+
+    @property
+    def population(self) -> int:
+        return self.root.population
+
+    def _life_4x4(self, node: _Node) -> _Node:
+        """level 2节点（4x4）中心2x2区域下一代的状态"""
+        grid = [[0] * 4 for _ in range(4)]
+        for r, c in self._cells_of(node):
+            grid[r][c] = 1
+        result = []
+        for r in (1, 2):
+            for c in (1, 2):
+                total = sum(grid[r + dr][c + dc] for dr in (-1, 0, 1) for dc in (-1, 0, 1)) - grid[r][c]
+                result.append(self._on if total == 3 or total == 2 and grid[r][c] else self._off)
+        return self._join(*result)
+
+    @staticmethod
+    def _cells_of(node: _Node):
+        for quadrant, (r, c) in ((node.nw, (0, 0)), (node.ne, (0, 2)), (node.sw, (2, 0)), (node.se, (2, 2))):
+            for leaf, (dr, dc) in ((quadrant.nw, (0, 0)), (quadrant.ne, (0, 1)), (quadrant.sw, (1, 0)),
+                                   (quadrant.se, (1, 1))):
+                if leaf.population:
+                    yield r + dr, c + dc
+
+    def _successor(self, node: _Node, j: int) -> _Node:
+        """节点中心边长一半的区域在2^min(j, level-2)代之后的状态"""
+        if node.population == 0:
+            return node.nw
+        j = min(j, node.level - 2)
+        key = (node, j)
+        result = self._results.get(key)
+        if result is not None:
+            return result
+        if node.level == 2:
+            result = self._life_4x4(node)
+        else:
+            join, successor = self._join, self._successor
+            nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+            c1 = successor(nw, j)
+            c2 = successor(join(nw.ne, ne.nw, nw.se, ne.sw), j)
+            c3 = successor(ne, j)
+            c4 = successor(join(nw.sw, nw.se, sw.nw, sw.ne), j)
+            c5 = successor(join(nw.se, ne.sw, sw.ne, se.nw), j)
+            c6 = successor(join(ne.sw, ne.se, se.nw, se.ne), j)
+            c7 = successor(sw, j)
+            c8 = successor(join(sw.ne, se.nw, sw.se, se.sw), j)
+            c9 = successor(se, j)
+            if j < node.level - 2:
+                # 9个子区域已经前进了2^j代，直接拼出中心区域
+                result = join(join(c1.se, c2.sw, c4.ne, c5.nw), join(c2.se, c3.sw, c5.ne, c6.nw),
+                              join(c4.se, c5.sw, c7.ne, c8.nw), join(c5.se, c6.sw, c8.ne, c9.nw))
+            else:
+                # 再前进2^(level-3)代，合计2^(level-2)代
+                result = join(successor(join(c1, c2, c4, c5), j), successor(join(c2, c3, c5, c6), j),
+                              successor(join(c4, c5, c7, c8), j), successor(join(c5, c6, c8, c9), j))
+        self._results[key] = result
+        return result
+
+    def step(self):
+        j = self.step_log2
+        root = self.root
+        # Life中图案在空白区域的扩张速度不超过c/2，图案位于中心1/4区域并且level >= j+2时，结果不会越出successor返回的区域
+        while root.level < j + 3 or root.nw.population != root.nw.se.se.population or \
+                root.ne.population != root.ne.sw.sw.population or \
+                root.sw.population != root.sw.ne.ne.population or \
+                root.se.population != root.se.nw.nw.population:
+            root = self._expand(root)
+        self.root = self._successor(root, j)
+        self.generation += 1 << j
+        if len(self._nodes) > self.max_nodes:
+            self._collect()
+
+    def _collect(self):
+        """丢弃记忆的结果，节点表中只保留当前图案用到的节点"""
+        self._results = {}
+        self._empty = []
+        nodes = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.level == 0:
+                continue
+            key = (node.nw, node.ne, node.sw, node.se)
+            if key not in nodes:
+                nodes[key] = node
+                stack.extend(key)
+        self._nodes = nodes
+
+
+class BitEngine:
+    """
+    位压缩的棋盘：每行保存为uint64数组，每个字64个细胞（第k个字的第j位是第64k+j列），1亿个细胞的棋盘只占12.5M
+    每代用位运算一次处理64个细胞：先用全加器求每行左、中、右三格的和(2位)，再把上中下三行的和相加得到包含自身的3x3邻域和(4位)
+    和为3时下一代存活，和为4时保持原状态；按band行一段计算，临时数组的大小与棋盘无关
+    """
+
+    def __init__(self, height: int, width: int, wrap: bool = False, band: int = None):
+        self.height = height
+        self.width = width
+        self.wrap = wrap
+        self.words = -(-width // 64)
+        self.band = band or max(1, (1 << 18) // self.words)
+        self.board = np.zeros((height, self.words), dtype=np.uint64)
+        self.generation = 0
+        self._next = np.zeros_like(self.board)
+        self._mask = np.full(self.words, ~np.uint64(0), dtype=np.uint64)
+        if width % 64:
+            self._mask[-1] = np.uint64((1 << (width % 64)) - 1)
+
+    def _inside(self, cell) -> bool:
+        return 0 <= cell[0] < self.height and 0 <= cell[1] < self.width
+
+    def __contains__(self, cell) -> bool:
+        return self._inside(cell) and bool(int(self.board[cell[0], cell[1] >> 6]) >> (cell[1] & 63) & 1)
+
+    def add(self, cell):
+        if self._inside(cell):
+            self.board[cell[0], cell[1] >> 6] |= np.uint64(1 << (cell[1] & 63))
+
+    def discard(self, cell):
+        if self._inside(cell):
+            self.board[cell[0], cell[1] >> 6] &= ~np.uint64(1 << (cell[1] & 63))
+
+    def cells(self, region=None):
+        top, left, bottom, right = region or (0, 0, self.height, self.width)
+        top, left = max(top, 0), max(left, 0)
+        right = min(right, self.width)
+        rows = self.board[top:bottom, left >> 6:-(-right // 64)].astype("<u8")
+        bits = np.unpackbits(rows.view(np.uint8), axis=1, bitorder="little")
+        offset = left & 63
+        rows, cols = np.nonzero(bits[:, offset:offset + right - left])
+        return zip((rows + top).tolist(), (cols + left).tolist())
+
+    @property
+    def population(self) -> int:
+        if hasattr(np, "bitwise_count"):
+            return int(np.bitwise_count(self.board).sum(dtype=np.int64))
+        return int(np.unpackbits(self.board.view(np.uint8)).sum(dtype=np.int64))
+
+    def _neighbors(self, rows: np.ndarray):
+        """每行的左邻居和右邻居移到细胞自身的位置上，跨字的位从相邻的字补上"""
+        one, top = np.uint64(1), np.uint64(63)
+        west = rows << one
+        west[:, 1:] |= rows[:, :-1] >> top
+        east = rows >> one
+        east[:, :-1] |= rows[:, 1:] << top
+        if self.wrap:
+            last_word, last_bit = divmod(self.width - 1, 64)
+            west[:, 0] |= (rows[:, last_word] >> np.uint64(last_bit)) & one
+            east[:, last_word] |= (rows[:, 0] & one) << np.uint64(last_bit)
+        return west, east
+
+    def step(self):
+        board, new, height = self.board, self._next, self.height
+        for start in range(0, height, self.band):
+            end = min(start + self.band, height)
+            # 取出这一段及上下各一行，棋盘外的行为0或者首尾相连
+            index = np.arange(start - 1, end + 1)
+            rows = board[index % height]
+            if not self.wrap:
+                rows[(index < 0) | (index >= height)] = 0
+            west, east = self._neighbors(rows)
+            # 每行三格的和：ones为1位，twos为2位
+            ones = west ^ rows ^ east
+            twos = (west & rows) | (east & (west ^ rows))
+            a0, b0, c0 = ones[:-2], ones[1:-1], ones[2:]
+            a1, b1, c1 = twos[:-2], twos[1:-1], twos[2:]
+            # 上中下三行相加：total = x0 + 2 * u0 + 4 * v0 + 8 * v1
+            x0 = a0 ^ b0 ^ c0
+            carry = (a0 & b0) | (c0 & (a0 ^ b0))
+            t0 = a1 ^ b1 ^ c1
+            t1 = (a1 & b1) | (c1 & (a1 ^ b1))
+            u0 = t0 ^ carry
+            u1 = t0 & carry
+            v0 = t1 ^ u1
+            v1 = t1 & u1
+            alive = rows[1:-1]
+            new[start:end] = ~v1 & ((x0 & u0 & ~v0) | (alive & ~x0 & ~u0 & v0)) & self._mask
+        self.board, self._next = new, board
+        self.generation += 1
+
+
+ENGINES = {"sparse": SparseEngine, "numpy": NumpyEngine, "hashlife": HashLifeEngine, "bits": BitEngine}
+
+
+def parse_rle(text: str) -> set:
+    """解析RLE格式的图案，返回活细胞(行, 列)的集合，左上角为(0, 0)；只支持B3/S23规则"""
+    lines = [line.strip() for line in text.splitlines() if line.strip() and not line.startswith("#")]
+    if lines and lines[0].startswith("x"):
+        rule = re.search(r"rule\s*=\s*([^,\s]+)", lines[0])
+        if rule and rule.group(1).upper() not in ("B3/S23", "23/3"):
+            raise ValueError(f"unsupported rule {rule.group(1)}")
+        lines = lines[1:]
+    cells = set()
+    row = col = 0
+    for count, tag in re.findall(r"(\d*)([bo$!])", "".join(lines)):
+        count = int(count) if count else 1
+        if tag == "!":
+            break
+        if tag == "$":
+            row, col = row + count, 0
+            continue
+        if tag == "o":
+            cells.update((row, col + i) for i in range(count))
+        col += count
+    return cells
+
+
+def random_cells(height: int, width: int, density: float = 0.3, seed: int = None) -> list:
+    rows, cols = np.nonzero(np.random.default_rng(seed).random((height, width)) < density)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def new_engine(name: str, height: int, width: int, cells=(), **kwargs):
+    engine = ENGINES[name](height, width, **kwargs)
+    for cell in cells:
+        engine.add(cell)
+    return engine
+
+
+def run_pattern(job: dict) -> dict:
+    """
+    在子进程中演化一个图案，job包括name、engine、height、width、generations，
+    以及rle（RLE文件路径，图案放在棋盘中央）或seed和density（随机汤）
+    """
+    height, width = job["height"], job["width"]
+    if job.get("rle"):
+        with open(job["rle"], "r", encoding="utf-8") as f:
+            pattern = parse_rle(f.read())
+        top = (height - max((r for r, _ in pattern), default=0)) // 2
+        left = (width - max((c for _, c in pattern), default=0)) // 2
+        cells = [(r + top, c + left) for r, c in pattern]
+    else:
+        cells = random_cells(height, width, job.get("density", 0.3), job.get("seed"))
+    engine = new_engine(job["engine"], height, width, cells)
+    initial = engine.population
+    start = time.perf_counter()
+    for _ in range(job["generations"]):
+        engine.step()
+    seconds = time.perf_counter() - start
+    return {
+        "name": job["name"],
+        "engine": job["engine"],
+        "initial": initial,
+        "population": engine.population,
+        "generation": engine.generation,
+        "seconds": seconds,
+        "cell_updates_per_s": height * width * engine.generation / seconds if seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless Game of Life engines")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    batch_parser = subparsers.add_parser("batch", help="evolve many patterns on a process pool")
+    batch_parser.add_argument("rle", nargs="*", help="RLE pattern files, random soups are used if empty")
+    batch_parser.add_argument("--count", type=int, default=8, help="number of random soups")
+    batch_parser.add_argument("--generations", type=int, default=1000)
+    batch_parser.add_argument("--engine", choices=list(ENGINES), default="sparse")
+    batch_parser.add_argument("--size", default="100x180", help="board size, HEIGHTxWIDTH")
+    batch_parser.add_argument("--density", type=float, default=0.3)
+    batch_parser.add_argument("--seed", type=int, default=0, help="seed of the first soup, the others count up")
+    batch_parser.add_argument("--workers", type=int, default=None)
+    batch_parser.add_argument("--output", default=None, help="append results to this jsonl file")
+    args = parser.parse_args()
+
+    height, width = (int(v) for v in args.size.lower().split("x"))
+    job = {"engine": args.engine, "height": height, "width": width, "generations": args.generations}
+    if args.rle:
+        jobs = [{**job, "name": os.path.basename(path), "rle": path} for path in args.rle]
+    else:
+        jobs = [{**job, "name": f"soup-{args.seed + i}", "seed": args.seed + i, "density": args.density}
+                for i in range(args.count)]
+    start = time.perf_counter()
+    print(f"{'pattern':<30} {'initial':>9} {'final':>9} {'gens':>7} {'seconds':>9} {'Mcells/s':>9}")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(run_pattern, jobs))
+    for result in results:
+        rate = "-" if result["cell_updates_per_s"] is None else f"{result['cell_updates_per_s'] / 1e6:.1f}"
+        print(f"{result['name']:<30} {result['initial']:>9} {result['population']:>9} {result['generation']:>7} "
+              f"{result['seconds']:>9.3f} {rate:>9}")
+    seconds = time.perf_counter() - start
+    print(f"{len(results)} patterns, {sum(r['generation'] for r in results)} generations in {seconds:.2f}s")
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
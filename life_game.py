@@ -1,11 +1,14 @@
 import sys
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget
-from PyQt5.QtGui import QKeyEvent, QMouseEvent, QPainter, QPen, QResizeEvent
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QImage, QKeyEvent, QMouseEvent, QPainter, QPen, QPixmap, QRegion, QResizeEvent
+from PyQt5.QtCore import QRect, Qt, QTimer
+import numpy as np
+
+from life_engine import ENGINES, HashLifeEngine
 
 
 class LifeGame(QWidget):
-    def __init__(self):
+    def __init__(self, engine: str = "sparse"):
         super().__init__()
         self.width = 1810
         self.height = 1000
@@ -13,28 +16,45 @@ class LifeGame(QWidget):
         self.grid_width = 180
         self.grid_height = 100
         self.speed = 200
-        self.grid = [[False] * self.grid_width for _ in range(self.grid_height)]
-        self.lives = set()
+        self.engine = ENGINES[engine](self.grid_height, self.grid_width)
+        # 每个细胞对应图像中的一个像素，0为活细胞，255为空白，绘制时按cell_size放大
+        self.pixels = np.full((self.grid_height, self.grid_width), 255, np.uint8)
+        self.image = QImage(self.pixels.data, self.grid_width, self.grid_height, self.pixels.strides[0],
+                            QImage.Format_Grayscale8)
+        self.grid_pixmap = None
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_game)
         self.timer.start(200)  # Update every 100ms
 
     def update_game(self):
-        neighbor_cnt = {}
-        for x, y in self.lives:
-            for dx in (-1, 0, 1):
-                for dy in (-1, 0, 1):
-                    if dx == 0 and dy == 0:
-                        continue
-                    neighbor_cnt[(x + dx, y + dy)] = neighbor_cnt.get((x + dx, y + dy), 0) + 1
-        new_lives = set()
-        for key, cnt in neighbor_cnt.items():
-            if cnt == 3:
-                new_lives.add(key)
-            elif cnt == 2 and key in self.lives:
-                new_lives.add(key)
-        self.lives = new_lives
-        self.update()
+        self.engine.step()
+        self.refresh()
+
+    def refresh(self):
+        """把引擎中的活细胞同步到图像缓冲区，只重绘出生和死亡的细胞所在的区域"""
+        view = np.full_like(self.pixels, 255)
+        cells = np.array(list(self.engine.cells((0, 0, self.grid_height, self.grid_width))), dtype=np.intp)
+        if len(cells):
+            view[cells[:, 0], cells[:, 1]] = 0
+        changed = view != self.pixels
+        if not changed.any():
+            return
+        self.pixels[...] = view
+        # 每个有变化的行合并成一个矩形，区域最多grid_height个矩形
+        region, size = QRegion(), self.cell_size
+        for i in np.flatnonzero(changed.any(axis=1)).tolist():
+            cols = np.flatnonzero(changed[i])
+            left, right = int(cols[0]), int(cols[-1]) + 1
+            region = region.united(QRect(left * size - 1, i * size - 1, (right - left) * size + 2, size + 2))
+        self.update(region)
+
+    def set_engine(self, name: str):
+        """切换演化引擎，保留当前的活细胞（numpy引擎会丢弃棋盘外的细胞）"""
+        engine = ENGINES[name](self.grid_height, self.grid_width)
+        for cell in self.engine.cells():
+            engine.add(cell)
+        self.engine = engine
+        self.refresh()
 
     def resizeEvent(self, event: QResizeEvent | None) -> None:
         print(event.size(), "in")
@@ -43,41 +63,58 @@ class LifeGame(QWidget):
         x, y = event.pos().x() // self.cell_size, event.pos().y() // self.cell_size
         if 0 <= x < self.grid_width and 0 <= y < self.grid_height:
             self.change_status(y, x)
-            self.update()
+            self.refresh()
 
     def change_status(self, x: int, y: int):
-        if (x, y) in self.lives:
-            self.lives.discard((x, y))
+        if (x, y) in self.engine:
+            self.engine.discard((x, y))
         else:
-            self.lives.add((x, y))
+            self.engine.add((x, y))
 
     def mouseMoveEvent(self, event: QMouseEvent | None) -> None:
         x, y = event.pos().x() // self.cell_size, event.pos().y() // self.cell_size
         if 0 <= x < self.grid_width and 0 <= y < self.grid_height:
             if event.buttons() == Qt.LeftButton:
-                self.lives.add((y, x))
+                self.engine.add((y, x))
             elif event.buttons() == Qt.RightButton:
-                self.lives.discard((y, x))
-            self.update()
+                self.engine.discard((y, x))
+            self.refresh()
+
+    def _grid_background(self) -> QPixmap:
+        """网格线只画一次，缓存在透明的pixmap中，每次绘制时叠加在细胞图像上"""
+        if self.grid_pixmap is None:
+            size = self.cell_size
+            self.grid_pixmap = QPixmap(self.grid_width * size + 2, self.grid_height * size + 2)
+            self.grid_pixmap.fill(Qt.transparent)
+            painter = QPainter(self.grid_pixmap)
+            painter.setPen(QPen(Qt.gray, 2))
+            for i in range(self.grid_height):
+                for j in range(self.grid_width):
+                    painter.drawRect(j * size, i * size, size, size)
+            painter.end()
+        return self.grid_pixmap
 
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.setBackground(Qt.white)
+        rect, size = event.rect(), self.cell_size
+        top, left = max(rect.top() // size, 0), max(rect.left() // size, 0)
+        bottom = min(rect.bottom() // size + 1, self.grid_height)
+        right = min(rect.right() // size + 1, self.grid_width)
+        if top < bottom and left < right:
+            source = QRect(left, top, right - left, bottom - top)
+            painter.drawImage(QRect(left * size, top * size, source.width() * size, source.height() * size),
+                              self.image, source)
+        painter.drawPixmap(rect, self._grid_background(), rect)
         painter.setPen(QPen(Qt.gray, 2))
-        painter.drawText(0,0,self.cell_size,self.cell_size,1,"0")
-        for i, j in self.lives:
-            painter.fillRect(j * self.cell_size, i * self.cell_size, self.cell_size, self.cell_size, Qt.black)
-        for i in range(self.grid_height):
-            for j in range(self.grid_width):
-                painter.drawRect(j * self.cell_size, i * self.cell_size, self.cell_size, self.cell_size)
+        painter.drawText(0, 0, self.cell_size, self.cell_size, 1, "0")
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, engine: str = "sparse"):
         super().__init__()
         self.setWindowTitle("Conway's Game of Life")
         self.setGeometry(0, 0, 1840, 1000)
-        self.central_widget = LifeGame()
+        self.central_widget = LifeGame(engine)
         self.setCentralWidget(self.central_widget)
 
     def keyPressEvent(self, event: QKeyEvent | None) -> None:
@@ -95,13 +132,23 @@ class MainWindow(QMainWindow):
         elif event.key() == Qt.Key_C:
             self.central_widget.speed += 5
             self.central_widget.timer.setInterval(self.central_widget.speed)
+        elif event.key() == Qt.Key_E:
+            names = list(ENGINES)
+            current = next(name for name, cls in ENGINES.items() if isinstance(self.central_widget.engine, cls))
+            self.central_widget.set_engine(names[(names.index(current) + 1) % len(names)])
+            self.setWindowTitle(f"Conway's Game of Life ({type(self.central_widget.engine).__name__})")
+        elif event.key() in (Qt.Key_J, Qt.Key_K) and isinstance(self.central_widget.engine, HashLifeEngine):
+            # hashlife每步前进的代数加倍/减半
+            engine = self.central_widget.engine
+            engine.step_log2 = max(0, engine.step_log2 + (1 if event.key() == Qt.Key_J else -1))
+            self.setWindowTitle(f"Conway's Game of Life (HashLifeEngine, 2^{engine.step_log2} generations per step)")
         self.update()
         return super().keyPressEvent(event)
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
-    window = MainWindow()
+    window = MainWindow(sys.argv[1] if len(sys.argv) > 1 else "sparse")
     window.show()
     sys.exit(app.exec_())
 
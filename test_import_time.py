@@ -0,0 +1,16 @@
+"""
+import download 只应加载标准库中的轻量模块，requests、urllib3等在第一次发起请求时才导入
+"""
+import os.path
+import subprocess
+import sys
+
+HEAVY_MODULES = ("requests", "urllib3", "concurrent.futures", "argparse")
+
+
+def test_import_download_is_lazy():
+    # 在新的解释器中导入，避免受本进程中已经导入的模块影响
+    code = f"import sys, download; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.stdout.split() == []